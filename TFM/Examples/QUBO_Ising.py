@@ -84,20 +84,32 @@ Q = np.array([[10,  2,  1],
 
 best_cost_brute = 0
 
-# computing all possible combinations
+# characters interacting with each character (non-zero Q terms,
+# symmetrized so that upper triangular Q matrices also work)
+Q_sym = Q + Q.T
+neighbours = [[j for j in range(n) if j != i and Q_sym[i,j] != 0] for i in range(n)]
+
+# computing all possible combinations in Gray-code order:
+# two consecutive combinations differ by a single character,
+# so the score can be updated looking only at its neighbours
+x = [0] * n
+cost = 0
 for b in range(2**n):
-    # x stores all the 2^n possible combinations of 0 and 1
-    # for a vector of length n 
-    x = [int(t) for t in reversed(list(bin(b)[2:].zfill(n)))]
-    cost = 0
+    if b > 0:
+        # the character to flip is given by the lowest set bit of b
+        v = (b & -b).bit_length() - 1
+        # score change when x_v goes from 0 to 1 (opposite sign otherwise)
+        delta = Q[v,v] + sum((Q[v,j] + Q[j,v])*x[j] for j in neighbours[v])
+        if x[v] == 0:
+            cost = cost + delta
+        else:
+            cost = cost - delta
+        x[v] = 1 - x[v]
     # scan all possible costs and keep the highest one
     # (now we want to maximize our score!)
-    for i in range(n):
-        for j in range(n):
-            cost = cost + Q[i,j]*x[i]*x[j]
     if best_cost_brute < cost:
         best_cost_brute = cost
-        xbest_brute = x 
+        xbest_brute = list(x)
     print('case = ' + str(x)+ ' score = ' + str(cost))
 
 # Showing results    
@@ -371,6 +383,30 @@ print("Ising Hamiltonian:")
 print(H)
 
 
+# The Hamiltonian is diagonal, so we do not need to build the whole $2^n \times 2^n$ matrix: its diagonal can be computed directly from the bit patterns of the $2^n$ states. This allows to check the equivalence between the Ising and QUBO formulations for 20 qbits and more.
+
+# In[ ]:
+
+
+# Diagonal of the Ising Hamiltonian, computed from the bit patterns
+def qubo_to_ising_diagonal(input_Q):
+    n = len(input_Q)
+    # bits of all the 2^n states (the first qbit is the most significant one):
+    # x_i = 1 corresponds to the |0> state of the i-th qbit
+    states = np.arange(2**n)
+    x = 1 - ((states[:, None] >> np.arange(n-1, -1, -1)) & 1)
+    return -(x.dot(input_Q) * x).sum(axis = 1)
+
+# Same result as the full matrix
+print(np.array_equal(qubo_to_ising_diagonal(Q), np.diag(H)))
+
+# ... and it can be used with many more qbits
+Q_20 = np.random.randint(-10, 11, size = (20, 20))
+Q_20 = Q_20 + Q_20.T
+H_20 = qubo_to_ising_diagonal(Q_20)
+print('Ising Hamiltonian diagonal dimensions:' + str(H_20.shape))
+
+
 # In[18]:
 
 
@@ -1,7 +1,29 @@
 import numpy as np
 import pandas as pd
-from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister, execute, Aer
-from qiskit import IBMQ
+from scipy import sparse
+import warnings
+# qiskit is not needed by the NumPy simulators ('numpy_simulator' and
+# 'mps_simulator' backends). Each group of optional imports is tried on
+# its own, so that a missing legacy module does not hide the others
+try:
+    from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister
+    from qiskit import transpile
+    from qiskit.circuit import ParameterVector
+    from qiskit.quantum_info import Statevector
+except ImportError:
+    warnings.warn("qiskit not found: only the 'numpy_simulator' and 'mps_simulator' backends are available")
+try:
+    from qiskit_aer import Aer
+except ImportError:
+    try:
+        from qiskit import Aer
+    except ImportError:
+        Aer = None
+        warnings.warn("qiskit-aer not found: the 'qasm_simulator' backend is not available")
+try:
+    from qiskit import IBMQ
+except ImportError:
+    IBMQ = None
 import pickle
 import sys
 import matplotlib.pyplot as plt 
@@ -13,7 +35,14 @@ PI = np.pi
 
 
 # The actual function
-def qubo_to_ising(input_Q):
+def qubo_to_ising(input_Q, output = "dense"):
+    """Translates a QUBO matrix into the corresponding Ising Hamiltonian.
+
+    output: 'dense' returns the 2^n x 2^n matrix built with Kronecker
+    products, 'diagonal' only its 2^n diagonal (see 'ising_diagonal'),
+    since the Hamiltonian is diagonal, and 'sparse' the same diagonal
+    as a scipy.sparse.diags operator.
+    """
 
     # Define the 2x2 matrices we need
 
@@ -30,6 +59,13 @@ def qubo_to_ising(input_Q):
     print("input:")
     print(input_Q)
     print("")
+
+    if output == "diagonal":
+        return ising_diagonal(input_Q)
+    elif output == "sparse":
+        return sparse.diags(ising_diagonal(input_Q))
+    elif output != "dense":
+        raise ValueError("Please select a valid output ('dense', 'diagonal' or 'sparse')")
     
     # initialize H
     H = 0
@@ -67,30 +103,263 @@ def qubo_to_ising(input_Q):
     return(-H)
 
 
+# Diagonal of the Ising Hamiltonian returned by 'qubo_to_ising'
+def ising_diagonal(input_Q, chunk_size = 2**16):
+    """Returns the 2^n diagonal of the Ising Hamiltonian of a QUBO matrix.
+
+    The energies are computed directly from the bit patterns of the
+    states, in chunks of 'chunk_size' states, with the same conventions
+    as 'qubo_to_ising': the first qbit is the most significant one and
+    x_i = 1 corresponds to the |0> state of qbit i.
+    """
+    n = len(input_Q)
+    input_Q = np.asarray(input_Q, dtype = float)
+    diagonal = np.empty(2**n)
+    for start in range(0, 2**n, chunk_size):
+        stop = min(start + chunk_size, 2**n)
+        x = 1 - bits_from_integers(np.arange(start, stop), n)[:, ::-1]
+        # x_i (1 - x_j) terms, plus x_i for the diagonal of Q
+        diagonal[start:stop] = -(cut_values(x, input_Q) + x.dot(np.diag(input_Q)))
+    return diagonal
+
+
+# Ising form of a QUBO matrix as coefficient arrays
+def qubo_to_pauli(input_Q):
+    """Returns the Ising form (h, J, offset) of a QUBO matrix.
+
+    With z_i = 1 - 2 x_i (z_i = +1 for the |0> state of the vertex),
+    the energy -x.Q.(1-x) of an assignment (the one used by
+    'cost_function_C' and 'cv_a_r') is:
+        offset + h.z + sum_{i<j} J_ij z_i z_j
+    h: ndarray of the n local fields,
+    J: scipy.sparse.coo_matrix (upper triangular) of the couplings,
+    offset: the constant term.
+
+    The diagonal of Q does not contribute, since x_i (1 - x_i) = 0.
+    Only the non-zero terms of Q are visited: O(n + nnz).
+    """
+    n = input_Q.shape[0]
+    Q = sparse.coo_matrix(input_Q)
+    off_diag = Q.row != Q.col
+    rows, cols, values = Q.row[off_diag], Q.col[off_diag], Q.data[off_diag].astype(float)
+
+    # x_i (1 - x_j) = (1 + z_j - z_i - z_i z_j) / 4
+    offset = -values.sum() / 4
+    h = (np.bincount(rows, values, minlength = n) - np.bincount(cols, values, minlength = n)) / 4
+    J = sparse.coo_matrix((values / 4, (np.minimum(rows, cols), np.maximum(rows, cols))),
+                          shape = (n, n))
+    J.sum_duplicates()
+    return h, J, offset
+
+
+# Energies of a set of assignments from the Ising coefficients
+def ising_energies(x, h, J, offset):
+    """Returns offset + h.z + sum_{i<j} J_ij z_i z_j for each row of the
+    bit matrix x, with z = 1 - 2x (see 'qubo_to_pauli').
+    """
+    z = 1 - 2*np.atleast_2d(x).astype(float)
+    return offset + z.dot(h) + (z * (J.dot(z.T)).T).sum(axis = 1)
+
+
+# Convert a counts dictionary into a bit matrix
+def counts_to_bits(results):
+    """Returns the eigenstates of a counts dictionary as a uint8 bit
+    matrix (one row per eigenstate, column k = character k of the
+    bitstring) and the ndarray of their abundances.
+    """
+    eigenstates = list(results.keys())
+    abundancies = np.fromiter(results.values(), dtype = float, count = len(eigenstates))
+    return strings_to_bits(eigenstates), abundancies
+
+
+# Convert a list of bitstrings into a bit matrix
+def strings_to_bits(eigenstates):
+    """Returns the uint8 bit matrix of a list of bitstrings of the
+    same length (column k = character k of the bitstring).
+    """
+    x = np.frombuffer("".join(eigenstates).encode(), dtype = np.uint8) - ord("0")
+    x.shape = (len(eigenstates), len(eigenstates[0]))
+    return x
+
+
+# Energies of the rows of a bit matrix
+def bits_energies(x, weights, ising = None):
+    """Returns the energies -x.Q.(1-x) of the rows of the bit matrix x,
+    computed with one matrix product, or from the Ising form
+    (h, J, offset) of weights if given (see 'qubo_to_pauli').
+    """
+    if ising is None:
+        return -cut_values(x, weights)
+    return ising_energies(x, *ising)
+
+
+# Pack the rows of a bit matrix into integers
+def pack_bits(x):
+    """Returns the integers int(bitstring, 2) of the rows of the bit
+    matrix x (column 0 is the most significant bit), as an int64
+    ndarray, or an object ndarray of Python integers above 62 bits.
+    """
+    n_bits = x.shape[1]
+    if n_bits <= 62:
+        return x.dot(np.left_shift(1, np.arange(n_bits - 1, -1, -1, dtype = np.int64)))
+    packed = np.empty(len(x), dtype = object)
+    packed[:] = [int("".join(map(str, row)), 2) for row in x.tolist()]
+    return packed
+
+
+# Keep the energies of the bitstrings already seen
+from collections import OrderedDict
+
+class EnergyCache:
+    """Cache of the energies -x.Q.(1-x) of the bitstrings of a QUBO matrix.
+
+    weights: the QUBO matrix the cache is bound to,
+    capacity: maximum number of energies kept; the least recently
+    used ones are evicted first,
+    full_table: if True (and n <= 20), the energies of all the 2^n
+    bitstrings are computed once and no eviction is needed,
+    ising: optional (h, J, offset) Ising form of weights (see 'qubo_to_pauli').
+
+    The keys are the packed integers int(bitstring, 2), kept in a few
+    sorted runs: a batch is looked up with one 'searchsorted' per run.
+    The energies of the missing bitstrings of a batch are computed with
+    one matrix product and added as a new run; a run is merged with the
+    previous one when it gets as large as half of it, so that the runs
+    have geometric sizes and a batch never re-sorts the whole cache.
+    When full, the least recently used entries are evicted down to 90%
+    of capacity. 'hits' and 'misses' count the bitstrings served from
+    the cache and the ones that had to be computed.
+
+    The energy of a bitstring is a cheap matrix product: up to 20
+    vertices full_table is faster than the sorted runs, which pay off
+    for large or expensive (e.g. dense) problems.
+    """
+    def __init__(self, weights, capacity = 2**20, full_table = False, ising = None):
+        self.weights  = weights
+        self.n_bits   = len(weights)
+        self.capacity = capacity
+        self.ising    = ising
+        self.table    = None
+        self.clear()
+        if full_table == True:
+            if self.n_bits > 20:
+                raise ValueError("The full energy table is only available up to 20 vertices")
+            self.table = energy_table(weights, ising)
+
+    def lookup(self, x, packed = None):
+        """Returns the energies of the rows of the bit matrix x.
+        packed: the integers of the rows of x, if already known.
+        """
+        if packed is None:
+            packed = pack_bits(x)
+        if self.table is not None:
+            self.hits += len(packed)
+            return self.table[packed]
+
+        # Sorted queries: 'searchsorted' walks the runs in order
+        self.n_lookups += 1
+        order  = np.argsort(packed, kind = "stable")
+        sorted_keys = packed[order]
+        energies = np.empty(len(packed))
+        found  = np.zeros(len(packed), dtype = bool)
+        for keys, values, last_used in self.runs:
+            position = np.searchsorted(keys, sorted_keys)
+            hit = keys[np.minimum(position, len(keys) - 1)] == sorted_keys
+            energies[hit] = values[position[hit]]
+            last_used[position[hit]] = self.n_lookups
+            found |= hit
+        n_missing = len(packed) - int(np.count_nonzero(found))
+        self.hits   += len(packed) - n_missing
+        self.misses += n_missing
+
+        if n_missing > 0:
+            # Compute each missing key once and store them as a new run
+            missing = np.nonzero(~found)[0]
+            first = np.ones(len(missing), dtype = bool)
+            first[1:] = sorted_keys[missing[1:]] != sorted_keys[missing[:-1]]
+            new_values = bits_energies(x[order[missing[first]]], self.weights, self.ising)
+            energies[missing] = new_values[np.cumsum(first) - 1]
+            self.runs.append((sorted_keys[missing[first]], new_values,
+                              np.full(np.count_nonzero(first), self.n_lookups)))
+            self.size += len(new_values)
+            while len(self.runs) > 1 and 2 * len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+                self.runs[-2:] = [self.merge(self.runs[-2:])]
+            if self.size > self.capacity:
+                self.runs = [self.merge(self.runs, int(0.9 * self.capacity))]
+                self.size = len(self.runs[0][0])
+
+        eigenvalues = np.empty(len(packed))
+        eigenvalues[order] = energies
+        return eigenvalues
+
+    def merge(self, runs, keep = None):
+        """Returns the sorted run made of runs, keeping only the keep
+        most recently used entries if given."""
+        keys, values, last_used = [np.concatenate(arrays) for arrays in zip(*runs)]
+        if keep is not None and len(keys) > keep:
+            recent = np.sort(np.argsort(-last_used, kind = "stable")[:keep])
+            keys, values, last_used = keys[recent], values[recent], last_used[recent]
+        # sorted runs: the stable sort merges them in linear time
+        order = np.argsort(keys, kind = "stable")
+        return keys[order], values[order], last_used[order]
+
+    def stats(self):
+        """Returns a dictionary with the hits, misses, hit rate and size of the cache."""
+        lookups = self.hits + self.misses
+        return {"hits"     : self.hits,
+                "misses"   : self.misses,
+                "hit_rate" : self.hits / lookups if lookups > 0 else 0,
+                "size"     : self.size if self.table is None else len(self.table)}
+
+    def clear(self):
+        """Empties the cache and resets the statistics."""
+        self.runs      = []
+        self.size      = 0
+        self.n_lookups = 0
+        self.hits      = 0
+        self.misses    = 0
+
+
+# Energies of all the bitstrings, indexed by int(bitstring, 2)
+def energy_table(weights, ising = None, chunk_size = 2**16):
+    """Returns the ndarray of the 2^n energies -x.Q.(1-x), where entry s
+    is the energy of the bitstring format(s, '0nb') (character k = vertex k).
+    """
+    n = len(weights)
+    table = np.empty(2**n)
+    for start in range(0, 2**n, chunk_size):
+        stop = min(start + chunk_size, 2**n)
+        x = bits_from_integers(np.arange(start, stop), n)[:, ::-1]
+        table[start:stop] = bits_energies(x, weights, ising)
+    return table
+
+
+# Energies and abundances of the eigenstates of a counts dictionary
+def counts_energies(results, weights, ising = None, cache = None):
+    """Returns the energies of the eigenstates of a counts dictionary
+    and their abundances, using the 'EnergyCache' cache if given.
+    """
+    x, abundancies = counts_to_bits(results)
+    if cache is None:
+        return bits_energies(x, weights, ising), abundancies
+    return cache.lookup(x), abundancies
+
+
 # Compute the value of the cost function
 # results: the results dictionary in the outcome of the circuit measurement
 # weights: the original QUBO matrix
-def cost_function_C(results, weights):
+# ising: optional (h, J, offset) Ising form of weights (see 'qubo_to_pauli')
+# cache: optional 'EnergyCache' bound to weights
+def cost_function_C(results, weights, ising = None, cache = None):
     
-    # the eigenstates obtained by the evaluation of the circuit
-    eigenstates = list(results.keys())
-    
-    # how many times each eigenstate has been sampled
-    abundancies = list(results.values())
+    # the energies of the eigenstates obtained by the evaluation
+    # of the circuit and how many times each of them has been sampled
+    eigenvalues, abundancies = counts_energies(results, weights, ising, cache)
     
     # number of shots 
-    shots = sum(results.values())
-    
-    # initialize the cost function
-    cost = 0
-    
-    for k in range(len(eigenstates)):
-        # ndarray of the digits extracted from the eigenstate string 
-        x = np.array([int(num) for num in eigenstates[k]])
-        # Cost function due to the k-th eigenstate
-        cost = cost + x.dot(weights.dot(1-x)) * abundancies[k]
+    shots = abundancies.sum()
     
-    return -cost / shots
+    return eigenvalues.dot(abundancies) / shots
 
 
 # Write a VQE circuit as a parametric function
@@ -137,62 +406,403 @@ def VQE_circuit(theta, n, depth):
 
 
 # Write a QAOA circuit as a parametric function
-def QAOA_circuit(gamma_beta, QUBO, depth): 
+def QAOA_circuit(gamma_beta, QUBO, depth, fix_vertex = None, ising = None): 
     """Creates a QAOA circuit.
     
     gamma_beta: input rotation angles.
     The first half of the variable contains the gamma angles
     and the second half the beta angles,
     QUBO: the original QUBO problem matrix,
-    depth: number of layers.
+    depth: number of layers,
+    fix_vertex: if set, this vertex is kept on side 0 and the
+    circuit is built on n-1 qbits (see 'QAOA_qbit_map'),
+    ising: if set to the (h, J, offset) Ising form of QUBO (see
+    'qubo_to_pauli'), the cost layers only contain the Z and ZZ
+    rotations with non-zero coefficients (see 'QAOA_cost_terms').
     """
             
     # prepare the quantum and classical registers
     n_vertices = len(QUBO)
+    qbit_map   = QAOA_qbit_map(n_vertices, fix_vertex, measured_order = ising is not None)
+    n_qbits    = len([v for v in qbit_map if v is not None])
 
-    if len(gamma_beta) != 2*depth + n_vertices:
-        raise ValueError("'gamma_beta' parameter length must be equal to twice 'depth' parameter plus the number of vertices")
+    if len(gamma_beta) != 2*depth + n_qbits:
+        raise ValueError("'gamma_beta' parameter length must be equal to twice 'depth' parameter plus the number of qbits")
 
     gamma = gamma_beta[0:depth]
     beta  = gamma_beta[depth:2*depth]
-    theta = gamma_beta[2*depth:2*depth + n_vertices]
+    theta = gamma_beta[2*depth:2*depth + n_qbits]
+
+    # gates of a cost layer
+    cost_terms = QAOA_cost_terms(QUBO, fix_vertex, ising)
     
     # Define the Quantum and Classical Registers
-    q = QuantumRegister(n_vertices)
-    c = ClassicalRegister(n_vertices)
+    q = QuantumRegister(n_qbits)
+    c = ClassicalRegister(n_qbits)
 
     # Build the circuit
     circuit = QuantumCircuit(q, c)
 
     # apply the layer of Hadamard gates to all qubits
     #circuit.h(range(n_vertices))
-    for i in range(n_vertices):
+    for i in range(n_qbits):
         circuit.ry(theta[i],q[i])
     circuit.barrier()
     
     # Repeat the circuit structure 'depth' times
     for k in range(depth):
         # apply the Ising type gates with angle gamma along the edges in E
-        for i in range(n_vertices):
-            for j in range(i,n_vertices):
-                if QUBO[i,j] != 0:
-                    circuit.cu1(-2*gamma[k]*QUBO[i,j], i, j)
-                    circuit.u1(gamma[k], i)
-                    circuit.u1(gamma[k], j)
+        for gate, coefficient, qbits in cost_terms:
+            getattr(circuit, gate)(coefficient*gamma[k], *qbits)
     
         # then apply the single qubit X-rotations with angle beta to all qubits
         circuit.barrier()
-        circuit.rx(2*beta[k], range(n_vertices))
+        circuit.rx(2*beta[k], range(n_qbits))
 
     # Finally measure the result in the computational basis
     circuit.barrier()
-    circuit.measure(range(n_vertices),range(n_vertices))
+    circuit.measure(range(n_qbits),range(n_qbits))
     
     return circuit    
 
 
+# Gates of a cost layer of a QAOA circuit
+def QAOA_cost_terms(QUBO, fix_vertex = None, ising = None):
+    """Returns the gates of one cost layer of 'QAOA_circuit'
+    as a list of (gate name, angle / gamma, qbits) tuples.
+
+    Without 'ising', each edge (i,j) gives a cu1(-2 gamma Q_ij) and two
+    u1(gamma) gates; an edge to the fixed vertex (always 0) only leaves
+    the u1 gate of the other vertex.
+    With ising = (h, J, offset) (see 'qubo_to_pauli') the layer is
+    exp(-i gamma H), made of the rz(2 gamma h_i) and rzz(2 gamma J_ij)
+    gates with non-zero coefficients only. The couplings to the fixed
+    vertex (z = +1) are folded into the field of the other vertex.
+    """
+    n_vertices = len(QUBO)
+    qbit_map   = QAOA_qbit_map(n_vertices, fix_vertex, measured_order = ising is not None)
+    terms = []
+
+    if ising is None:
+        for i in range(n_vertices):
+            for j in range(i,n_vertices):
+                if QUBO[i,j] != 0:
+                    qi, qj = qbit_map[i], qbit_map[j]
+                    if qi is None:
+                        terms.append(("u1", 1, (qj,)))
+                    elif qj is None:
+                        terms.append(("u1", 1, (qi,)))
+                    else:
+                        terms.append(("cu1", -2*QUBO[i,j], (qi, qj)))
+                        terms.append(("u1", 1, (qi,)))
+                        terms.append(("u1", 1, (qj,)))
+        return terms
+
+    h, J, offset = ising
+    h = np.array(h, dtype = float)
+    for i, j, value in zip(J.row, J.col, J.data):
+        if value == 0:
+            continue
+        if i == fix_vertex:
+            h[j] += value
+        elif j == fix_vertex:
+            h[i] += value
+        else:
+            terms.append(("rzz", 2*value, (qbit_map[i], qbit_map[j])))
+    for i in range(n_vertices):
+        if h[i] != 0 and i != fix_vertex:
+            terms.append(("rz", 2*h[i], (qbit_map[i],)))
+    return terms
+
+
+# Qbit associated to each vertex in a QAOA circuit
+def QAOA_qbit_map(n_vertices, fix_vertex = None, measured_order = False):
+    """Returns the list of the qbits associated to the vertices.
+
+    Without a fixed vertex, vertex i is mapped to qbit i, unless
+    measured_order is True: then vertex i is mapped to the qbit
+    read as character i of the measured bitstrings (qbit n-1-i).
+    If fix_vertex is set, that vertex has no qbit (None) and the
+    others are mapped so that, once 'expand_counts' inserts the fixed
+    vertex back, character i of each measured bitstring is vertex i.
+    """
+    if fix_vertex is None:
+        if measured_order == True:
+            return [n_vertices - 1 - v for v in range(n_vertices)]
+        return list(range(n_vertices))
+    qbit_map = []
+    for v in range(n_vertices):
+        if v == fix_vertex:
+            qbit_map.append(None)
+        else:
+            # position of the vertex in the (n-1)-long bitstring
+            position = v if v < fix_vertex else v - 1
+            qbit_map.append(n_vertices - 2 - position)
+    return qbit_map
+
+
+# Bring the results of a circuit with a fixed vertex back to n vertices
+def expand_counts(counts, fix_vertex):
+    """Inserts a '0' for vertex 'fix_vertex' in each bitstring
+    of a counts dictionary measured on n-1 qbits.
+    """
+    if fix_vertex is None:
+        return counts
+    return {key[:fix_vertex] + '0' + key[fix_vertex:] : value for key, value in counts.items()}
+
+
+# Number of qbits of a circuit for a problem with n_qbits vertices
+def circuit_qbits(n_qbits, fix_vertex = None):
+    """Returns n_qbits, or n_qbits-1 if a vertex is fixed."""
+    if fix_vertex is None:
+        return n_qbits
+    return n_qbits - 1
+
+
+# Circuits built once with symbolic angles
+class CircuitTemplate:
+    """A VQE or QAOA circuit built with symbolic angles.
+
+    circuit: the circuit, whose angles are the elements of 'parameters',
+    parameters: the ParameterVector, in the order of the 'params'
+    argument of 'VQE_circuit' (theta.ravel()) or 'QAOA_circuit' (gamma_beta),
+    key: the structure of the circuit (see 'circuit_template').
+
+    'bind' returns the circuit with numerical angles.
+    """
+    def __init__(self, circuit, parameters, key = None):
+        self.circuit    = circuit
+        self.parameters = parameters
+        self.key        = key
+        # angles which actually appear in the circuit
+        used = set(circuit.parameters)
+        self.used = [k for k, parameter in enumerate(parameters) if parameter in used]
+
+    def bind(self, values):
+        """Returns the circuit with the angles set to values."""
+        values = np.ravel(values)
+        if len(values) != len(self.parameters):
+            raise ValueError("The template needs {0} angles, {1} given".format(len(self.parameters), len(values)))
+        return self.circuit.assign_parameters({self.parameters[k] : values[k] for k in self.used})
+
+
+# Key of a QUBO problem in the caches of this process
+def problem_key(weights, *options):
+    """Returns a hashable key of the QUBO matrix weights (its values,
+    shape and dtype), preceded by the options the cached object
+    depends on (algorithm, depth, fix_vertex, ...).
+    """
+    Q = np.asarray(weights)
+    return options + (Q.shape, Q.dtype.str, Q.tobytes())
+
+
+# Bounded caches of this process
+def cached_value(store, key, build, capacity):
+    """Returns store[key], calling build() to compute it the first time.
+    store is an OrderedDict holding the capacity most recently used
+    values (the older ones are evicted).
+    """
+    if key in store:
+        store.move_to_end(key)
+    else:
+        store[key] = build()
+        while len(store) > capacity:
+            store.popitem(last = False)
+    return store[key]
+
+
+# Templates already built in this process (the QAOA ones depend on
+# the QUBO matrix: only the most recent ones are kept)
+circuit_templates = OrderedDict()
+circuit_templates_capacity = 64
+
+def circuit_template(algorithm, n_qbits, depth, weights = None, fix_vertex = None, ising = None):
+    """Returns the 'CircuitTemplate' of a VQE or QAOA circuit,
+    building it only the first time it is requested.
+
+    algorithm: 'VQE' or 'QAOA',
+    n_qbits: number of vertices of the problem,
+    depth: number of layers,
+    weights: the QUBO matrix (only used by QAOA),
+    fix_vertex, ising: see 'QAOA_circuit' and 'circuit_qbits'.
+
+    The QAOA angles of the cost layers depend on the QUBO values, so
+    the QUBO matrix (and not only its non-zero pattern) is part of the key.
+    """
+    n_circuit = circuit_qbits(n_qbits, fix_vertex)
+    if algorithm == "VQE":
+        key = (algorithm, n_circuit, depth)
+    elif algorithm == "QAOA":
+        key = problem_key(weights, algorithm, n_qbits, depth, fix_vertex, ising is not None)
+    else:
+        raise ValueError("Please select a valid algorithm")
+
+    def build():
+        if algorithm == "VQE":
+            parameters = ParameterVector("theta", (depth + 1) * n_circuit)
+            circuit = VQE_circuit(np.array(list(parameters), dtype = object), n_circuit, depth)
+        else:
+            parameters = ParameterVector("gamma_beta", 2*depth + n_circuit)
+            circuit = QAOA_circuit(parameters, np.asarray(weights), depth, fix_vertex, ising)
+        return CircuitTemplate(circuit, parameters, key)
+    return cached_value(circuit_templates, key, build, circuit_templates_capacity)
+
+
 # In case you want to use a real quantum device as backend
-from qiskit import IBMQ
+# The IBMQ provider, loaded at most once per process
+ibmq_provider = None
+
+def get_ibmq_provider():
+    """Returns the IBMQ provider, loading the account the first time."""
+    global ibmq_provider
+    if IBMQ is None:
+        raise ImportError("The IBMQ provider is not available in this qiskit version")
+    if ibmq_provider is None:
+        ibmq_provider = IBMQ.load_account()
+    return ibmq_provider
+
+
+# Backend resolved once and reused by all the circuit evaluations
+class BackendSession:
+    """Backend where the circuits are executed.
+
+    backend_name: 'qasm_simulator', 'numpy_simulator' (see
+    'circuit_probabilities'), 'mps_simulator' (see 'VQE_mps')
+    or the name of an IBMQ device,
+    seed: if set, the simulator seeds of the successive executions
+    are drawn from a random generator initialized with it, so that
+    a whole optimization can be reproduced,
+    n_threads: maximum number of threads used by the simulator
+    (None: the simulator default),
+    max_bond: maximum bond dimension of the 'mps_simulator'. The
+    truncation error of its last execution and the largest one are
+    kept in 'truncation_error' and 'max_truncation_error'.
+
+    The backend (and the IBMQ provider) is only resolved at the first
+    execution. Use 'backend_session' to share the sessions in a process.
+
+    The templates executed with 'run_template' are transpiled for the
+    backend once, and the transpiled circuits are kept by template key:
+    'compile_stats' returns the hits and misses of this cache.
+    """
+    def __init__(self, backend_name = 'qasm_simulator', seed = None, n_threads = None, max_bond = 64):
+        self.backend_name = backend_name
+        self.seed         = seed
+        self.n_threads    = n_threads
+        self.max_bond     = max_bond
+        self.truncation_error     = 0
+        self.max_truncation_error = 0
+        self.rng          = np.random.default_rng(seed)
+        self.backend      = None
+        self.n_jobs       = 0
+        self.compiled     = {}
+        self.compile_hits   = 0
+        self.compile_misses = 0
+        self.emulators    = {}
+
+    def get_backend(self):
+        """Returns the backend, resolving it the first time."""
+        if self.backend is None:
+            if self.backend_name == 'qasm_simulator':
+                if Aer is None:
+                    raise ImportError("qiskit-aer not found: the 'qasm_simulator' backend is not available")
+                self.backend = Aer.get_backend('qasm_simulator')
+            else:
+                self.backend = get_ibmq_provider().get_backend(self.backend_name)
+        return self.backend
+
+    def options(self):
+        """Returns the simulator options of the next execution."""
+        options = {}
+        if self.backend_name == 'qasm_simulator':
+            if self.seed is not None:
+                options["seed_simulator"] = int(self.rng.integers(2**31))
+            if self.n_threads is not None:
+                options["max_parallel_threads"] = self.n_threads
+        return options
+
+    def compile(self, template):
+        """Returns the 'CircuitTemplate' transpiled for the backend,
+        transpiling it only the first time.
+        """
+        key = (self.backend_name, template.key)
+        if key in self.compiled:
+            self.compile_hits += 1
+        else:
+            self.compile_misses += 1
+            circuit = transpile(template.circuit, self.get_backend())
+            self.compiled[key] = CircuitTemplate(circuit, template.parameters, template.key)
+        return self.compiled[key]
+
+    def run_template(self, template, values, shots):
+        """Binds values to the transpiled template, executes it
+        and returns the result.
+        If values is a 2-D array, one circuit per row is bound and
+        all of them are submitted as a single job (the counts of
+        row k are result.get_counts(k)).
+        """
+        compiled = self.compile(template)
+        if np.ndim(values) == 2:
+            circuit = [compiled.bind(row) for row in values]
+        else:
+            circuit = compiled.bind(values)
+        self.n_jobs += 1
+        return self.get_backend().run(circuit,
+                                      shots = shots,
+                                      **self.options()).result()
+
+    def sample_counts(self, probabilities, shots):
+        """Samples shots outcomes from the probabilities of the basis
+        states (see 'sample_counts') with the session random generator.
+        """
+        self.n_jobs += 1
+        return sample_counts(probabilities, shots, self.rng)
+
+    def emulator(self, weights, n_qbits, depth, algorithm = "VQE", fix_vertex = None, ising = None):
+        """Returns the 'ShotEmulator' of a problem, sharing the session
+        random generator, creating it only the first time. Only the
+        emulator of the last problem is kept (the distributions are 2^n
+        long), and 'clear_emulators' releases it at the end of a run.
+        """
+        key = problem_key(weights, algorithm, n_qbits, depth, fix_vertex, ising is not None)
+        if key not in self.emulators:
+            self.emulators.clear()
+            self.emulators[key] = ShotEmulator(weights, n_qbits, depth, algorithm, fix_vertex, ising,
+                                               self.backend_name, rng = self.rng)
+        return self.emulators[key]
+
+    def clear_emulators(self):
+        """Releases the 'ShotEmulator' distributions of the session."""
+        self.emulators.clear()
+
+    def run_mps(self, theta, n, depth, shots):
+        """Simulates the VQE ansatz as an MPS (see 'VQE_mps') and
+        returns the counts dictionary of shots measurements.
+        """
+        self.n_jobs += 1
+        tensors, self.truncation_error = VQE_mps(theta, n, depth, self.max_bond)
+        self.max_truncation_error = max(self.max_truncation_error, self.truncation_error)
+        return mps_sample_counts(tensors, shots, self.rng)
+
+    def compile_stats(self):
+        """Returns a dictionary with the hits, misses and size of the compile cache."""
+        return {"hits"   : self.compile_hits,
+                "misses" : self.compile_misses,
+                "size"   : len(self.compiled)}
+
+
+# Sessions already created in this process
+backend_sessions = {}
+
+def backend_session(backend_name = 'qasm_simulator', seed = None, n_threads = None, max_bond = 64):
+    """Returns the 'BackendSession' of these arguments,
+    creating it only the first time it is requested.
+    """
+    key = (backend_name, seed, n_threads, max_bond)
+    if key not in backend_sessions:
+        backend_sessions[key] = BackendSession(backend_name, seed, n_threads, max_bond)
+    return backend_sessions[key]
+
 
 def cost_function_cobyla(params, 
                          weights,   # = W, 
@@ -203,23 +813,44 @@ def cost_function_cobyla(params,
                          algorithm    = "VQE", 
                          alpha        = 0.5,
                          backend_name = 'qasm_simulator',
-                         verbosity    = False):
+                         verbosity    = False,
+                         fix_vertex   = None,
+                         ising        = None,
+                         cache        = None,
+                         session      = None,
+                         memo         = None):
     """Creates a circuit, executes it and computes the cost function.
     
     params: ndarray with the values of the parameters to be optimized,
     weights: the original QUBO matrix of the problem,
     n_qbits: number of qbits of the circuit,
     depth: number of layers of the ciruit,
-    shots: number of evaluations of the circuit state,
+    shots: number of evaluations of the circuit state. If None or
+    'exact', the statevector is simulated and the exact cost function
+    is computed from the probabilities (see 'exact_cost'). If it is a
+    'ShotSchedule', the schedule gives the shots of this evaluation
+    and is updated with its cost and shot noise. If it is a
+    'SequentialEstimator', the shots are drawn in batches until the
+    estimate is precise enough (see 'SequentialEstimator.estimate'),
     cost: the cost function to be used. It can be: 
      - 'cost': mean value of all measured eigenvalues
      - 'cvar': conditional value at risk = mean of the
                alpha*shots lowest eigenvalues,
     alpha: 'cvar' alpha parameter
-    verbosity: activate/desactivate some control printouts.
+    verbosity: activate/desactivate some control printouts,
+    fix_vertex: if set, this vertex is kept on side 0 and the circuit
+    is built on n_qbits-1 qbits (the Max-Cut problem is symmetric
+    under the exchange of the two sides),
+    ising: optional (h, J, offset) Ising form of weights (see 'qubo_to_pauli'),
+    used to build the QAOA cost layers and to evaluate the energies,
+    cache: optional 'EnergyCache' bound to weights, shared by all the
+    evaluations of the cost function,
+    session: the 'BackendSession' where the circuit is executed. If not
+    given, the session of backend_name is used (see 'backend_session'),
+    memo: optional 'CostMemo' of the parameter vectors already evaluated.
     
-    The function calls 'VQE_circuit' to create the circuit, then
-    evaluates it and compute the cost function.
+    The function evaluates the circuit of the algorithm with
+    params (see 'circuit_counts') and compute the cost function.
     """
     
     if (verbosity == True):
@@ -234,29 +865,61 @@ def cost_function_cobyla(params,
         print("alpha     = ", alpha)
         print("backend   = ", backend_name)
     
-    if algorithm == "VQE":
-        circuit = VQE_circuit(params, n_qbits, depth)
-    elif algorithm == "QAOA":
-        circuit = QAOA_circuit(params, weights, depth)
+    # Shots given by the schedule
+    schedule = None
+    if isinstance(shots, ShotSchedule):
+        schedule = shots
+        shots = schedule.next_shots()
     
-    if backend_name == 'qasm_simulator':
-        backend = Aer.get_backend('qasm_simulator')
-    else:
-        provider = IBMQ.load_account()
-        backend = provider.get_backend(backend_name)
+    # Shots drawn in batches by the sequential estimator
+    estimator = None
+    if isinstance(shots, SequentialEstimator):
+        estimator = shots
+        shots = estimator.batch_shots
     
-    # Execute the circuit on a simulator
-    job = execute(circuit, 
-                  backend = backend, 
-                  shots   = shots)
-    results = job.result()
+    # Parameter vector already evaluated
+    if memo is not None:
+        output = memo.cached_cost(params, is_exact(shots))
+        if output is not None:
+            if (verbosity == True):
+                print("cost = ", output, "(cached)")
+            return output
     
-    if cost == 'cost':
-        output = cost_function_C(results.get_counts(), weights)
-    elif cost == 'cvar':
-        output = cv_a_r(results.get_counts(), weights, alpha)
+    # Noiseless expectation: no sampling at all
+    if is_exact(shots):
+        probabilities = circuit_probabilities(params, weights, n_qbits, depth, algorithm,
+                                              fix_vertex, ising, backend_name)
+        energies = exact_energies(weights, fix_vertex, ising, cache)
+        output = exact_cost(probabilities, energies, cost, alpha)
+        if memo is not None:
+            memo.store(params, output)
+        if (verbosity == True):
+            print("cost = ", output)
+        return output
+    
+    if session is None:
+        session = backend_session(backend_name)
+    
+    if estimator is not None:
+        output, _ = estimator.estimate(params, weights, n_qbits, depth, cost, alpha,
+                                       algorithm, fix_vertex, ising, cache, session)
+        counts = estimator.counts
     else:
-        raise ValueError("Please select a valid cost function")
+        # Execute the circuit on a simulator
+        counts = circuit_counts(params, weights, n_qbits, depth, shots, algorithm,
+                                fix_vertex, ising, session)
+        
+        # Pool the shots of the previous visits of the same point
+        if memo is not None:
+            counts = memo.pooled_counts(params, counts)
+        
+        output = counts_cost(counts, weights, cost, alpha, ising, cache)
+    
+    if memo is not None:
+        memo.store(params, output, counts)
+    
+    if schedule is not None:
+        schedule.update(output, counts_cost_error(counts, weights, cost, alpha, ising, cache))
     
     if (verbosity == True):
         print("cost = ", output)
@@ -264,11 +927,1072 @@ def cost_function_cobyla(params,
     return output
 
 
+# Exact cost function and its gradient
+def cost_function_gradient(params, 
+                           weights, 
+                           n_qbits, 
+                           depth, 
+                           shots,
+                           cost,
+                           algorithm    = "VQE", 
+                           alpha        = 0.5,
+                           backend_name = 'numpy_simulator',
+                           verbosity    = False,
+                           fix_vertex   = None,
+                           ising        = None,
+                           cache        = None,
+                           session      = None):
+    """Returns the exact cost function and its gradient with respect to
+    params, computed with the NumPy simulators and the adjoint method
+    (see 'VQE_cost_gradient' and 'QAOA_cost_gradient').
+
+    The arguments are the ones of 'cost_function_cobyla'; shots must be
+    None or 'exact' and backend_name and session are not used.
+    """
+    if not is_exact(shots):
+        raise ValueError("The gradient is only available in exact mode (shots = None or 'exact')")
+
+    energies = exact_energies(weights, fix_vertex, ising, cache)
+    if algorithm == "VQE":
+        output, gradient = VQE_cost_gradient(params, circuit_qbits(n_qbits, fix_vertex), depth,
+                                             energies, cost, alpha)
+    elif algorithm == "QAOA":
+        output, gradient = QAOA_cost_gradient(params, weights, depth, energies, cost, alpha,
+                                              fix_vertex, ising)
+    else:
+        raise ValueError("Please select a valid algorithm")
+
+    if (verbosity == True):
+        print("cost = ", output)
+
+    return output, gradient
+
+
+# Keep the cost function of the parameter vectors already evaluated
+class CostMemo:
+    """Memo of the cost function evaluations of an optimization.
+
+    tolerance: the parameter vectors are rounded to multiples of
+    tolerance, so that points closer than that share the same entry,
+    capacity: maximum number of points kept (least recently used
+    evicted first),
+    pool_shots: in sampling mode, if False a point already visited
+    returns its cached cost; if True the circuit is executed again and
+    the new shots are pooled with the previous ones of the same point.
+    In exact mode the cached cost is always returned.
+
+    'cached' and 'executed' count the evaluations answered by the
+    memo and the ones which executed the circuit; 'pooled' counts the
+    executions whose shots were pooled with previous visits.
+
+    The keys are only the parameter vectors, so a memo belongs to one
+    optimization: 'clear' empties it (done by 'time_vs_shots' at the
+    beginning of each run, so repetitions are not answered by the
+    previous ones and different problems or costs do not mix).
+    """
+    def __init__(self, tolerance = 1e-6, capacity = 1024, pool_shots = False):
+        self.tolerance  = tolerance
+        self.capacity   = capacity
+        self.pool_shots = pool_shots
+        self.entries    = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        """Empties the memo and resets the counters."""
+        self.entries.clear()
+        self.cached     = 0
+        self.executed   = 0
+        self.pooled     = 0
+
+    def key(self, params):
+        """Returns the key of the rounded parameter vector."""
+        return np.round(np.ravel(params) / self.tolerance).astype(np.int64).tobytes()
+
+    def cached_cost(self, params, exact = False):
+        """Returns the cost of an already evaluated point, or None if the
+        circuit has to be executed.
+        """
+        key = self.key(params)
+        if key not in self.entries or (self.pool_shots == True and exact == False):
+            return None
+        self.entries.move_to_end(key)
+        self.cached += 1
+        return self.entries[key][0]
+
+    def pooled_counts(self, params, counts):
+        """Returns counts merged with the counts of the previous visits of
+        the point (pool_shots only).
+        """
+        key = self.key(params)
+        if self.pool_shots == False or key not in self.entries or self.entries[key][1] is None:
+            return counts
+        self.pooled += 1
+        pooled = dict(self.entries[key][1])
+        for state, value in counts.items():
+            pooled[state] = pooled.get(state, 0) + value
+        return pooled
+
+    def store(self, params, cost, counts = None):
+        """Stores the cost (and counts) of an executed evaluation."""
+        key = self.key(params)
+        self.executed += 1
+        self.entries[key] = (cost, counts if self.pool_shots == True else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+    def stats(self):
+        """Returns a dictionary with the cached and executed evaluations."""
+        return {"cached"   : self.cached,
+                "executed" : self.executed,
+                "pooled"   : self.pooled,
+                "size"     : len(self.entries)}
+
+
+# Number of shots of each evaluation of an optimization
+class ShotSchedule:
+    """Shots used by the successive evaluations of an optimization
+    (pass it as the 'shots' argument of 'time_vs_shots').
+
+    kind: 
+     - 'fixed': always shots_min shots,
+     - 'geometric': the shots are multiplied by growth every
+                    period evaluations,
+     - 'variance': the shots are multiplied by growth when, during the
+                   last period evaluations, the best cost did not improve
+                   by more than n_sigma times the estimated shot noise
+                   of the cost (see 'counts_cost_error'),
+    shots_min, shots_max: the first and the largest number of shots,
+    growth, period, n_sigma: see kind.
+
+    'total_shots' is the number of circuit evaluations used so far and
+    'history' the shots of each evaluation. 'reset' restarts the
+    schedule (done by 'time_vs_shots' at the beginning of each run).
+    """
+    def __init__(self, kind = "geometric", shots_min = 16, shots_max = 1024,
+                 growth = 2, period = 20, n_sigma = 1):
+        if kind not in ("fixed", "geometric", "variance"):
+            raise ValueError("Please select a valid shot schedule")
+        self.kind      = kind
+        self.shots_min = shots_min
+        self.shots_max = shots_max
+        self.growth    = growth
+        self.period    = period
+        self.n_sigma   = n_sigma
+        self.reset()
+
+    def reset(self):
+        """Restarts the schedule from shots_min."""
+        self.shots       = self.shots_min
+        self.total_shots = 0
+        self.history     = []
+        self.best        = np.inf
+        self.window      = []
+
+    def label(self):
+        """Name of the schedule, used in place of the number of shots
+        in the results of 'time_vs_shots'."""
+        return "{0}_{1}_{2}".format(self.kind, self.shots_min, self.shots_max)
+
+    def next_shots(self):
+        """Returns the shots of the next evaluation."""
+        return self.shots
+
+    def update(self, cost, error):
+        """Records an evaluation with the given cost and shot noise,
+        and updates the shots of the next ones."""
+        self.total_shots += self.shots
+        self.history.append(self.shots)
+        self.best = min(self.best, cost)
+        if self.kind == "geometric":
+            if len(self.history) % self.period == 0:
+                self.grow()
+        elif self.kind == "variance":
+            self.window.append(self.best)
+            if len(self.window) > self.period:
+                if self.window[0] - self.best <= self.n_sigma * error:
+                    self.grow()
+                    self.window = []
+                else:
+                    self.window.pop(0)
+
+    def grow(self):
+        """Multiplies the shots by growth, up to shots_max."""
+        self.shots = int(min(self.shots_max, self.shots * self.growth))
+
+
+# Cost function estimated with as few shots as needed
+class SequentialEstimator:
+    """Sequential sampling of the cost function (pass it as the 'shots'
+    argument of 'time_vs_shots' or 'cost_function_cobyla').
+
+    Each evaluation draws batches of batch_shots shots, and after each
+    batch computes the cost of all the shots drawn so far and its
+    confidence bound n_sigma * 'counts_cost_error'. Once at least
+    min_tail shots enter the cost (alpha*shots for 'cvar'), the sampling
+    stops when
+     - the bound is smaller than tolerance times |cost| (relative
+       precision, independent of the scale of the weights),
+     - the cost is clearly worse than the incumbent: its lower bound
+       is above the upper bound of the incumbent,
+     - or max_shots have been drawn.
+    The incumbent is the evaluation with the lowest upper bound so far,
+    so that the noisy low estimates of short evaluations do not
+    become the reference.
+
+    'total_shots' is the number of circuit evaluations used so far and
+    'history' the shots of each evaluation. 'reset' restarts the
+    incumbent and the counters (done by 'time_vs_shots' at the beginning
+    of each run).
+    """
+    def __init__(self, batch_shots = 32, max_shots = 1024, tolerance = 0.01, n_sigma = 2,
+                 min_tail = 32):
+        self.batch_shots = batch_shots
+        self.max_shots   = max_shots
+        self.tolerance   = tolerance
+        self.n_sigma     = n_sigma
+        self.min_tail    = min_tail
+        self.reset()
+
+    def reset(self):
+        """Forgets the incumbent and the shots used."""
+        self.incumbent       = np.inf
+        self.incumbent_bound = 0
+        self.total_shots     = 0
+        self.history         = []
+        self.counts          = None
+
+    def label(self):
+        """Name of the estimator, used in place of the number of shots
+        in the results of 'time_vs_shots'."""
+        return "sequential_{0}_{1}".format(self.batch_shots, self.max_shots)
+
+    def estimate(self, params, weights, n_qbits, depth, cost, alpha = 0.5, algorithm = "VQE",
+                 fix_vertex = None, ising = None, cache = None, session = None):
+        """Returns the estimated cost function of the circuit with angles
+        params and the number of shots used. The arguments are the ones of
+        'circuit_counts' and 'counts_cost'. The counts of all the batches
+        are left in 'counts'.
+        """
+        tail_fraction = alpha if cost == 'cvar' else 1
+        counts = {}
+        shots_used = 0
+        while True:
+            batch = circuit_counts(params, weights, n_qbits, depth, self.batch_shots,
+                                   algorithm, fix_vertex, ising, session)
+            for state, value in batch.items():
+                counts[state] = counts.get(state, 0) + value
+            shots_used += self.batch_shots
+            output = counts_cost(counts, weights, cost, alpha, ising, cache)
+            bound = self.n_sigma * counts_cost_error(counts, weights, cost, alpha, ising, cache)
+            if shots_used >= self.max_shots:
+                break
+            if tail_fraction * shots_used < self.min_tail:
+                continue
+            if (bound < self.tolerance * abs(output)
+                    or output - bound > self.incumbent + self.incumbent_bound):
+                break
+        if output + bound < self.incumbent + self.incumbent_bound:
+            self.incumbent, self.incumbent_bound = output, bound
+        self.total_shots += shots_used
+        self.history.append(shots_used)
+        self.counts = counts
+        return output, shots_used
+
+
+# Statistical uncertainty of the cost function of a counts dictionary
+def counts_cost_error(counts, weights, cost, alpha = 0.5, ising = None, cache = None):
+    """Returns the estimated standard error, due to the finite number of
+    shots, of the 'cost' or 'cvar' cost function of a counts dictionary:
+     - 'cost': sqrt(variance / shots) of the eigenvalues,
+     - 'cvar': sqrt(variance(Y) / (alpha^2 shots)), with
+       Y = min(eigenvalue - VaR, 0) and VaR the alpha quantile, the
+       asymptotic error of the CVaR estimate, which includes the
+       uncertainty of the quantile.
+    """
+    eigenvalues, abundancies = counts_energies(counts, weights, ising, cache)
+    shots = abundancies.sum()
+    probabilities = abundancies / shots
+    if cost == 'cvar':
+        order = np.argsort(eigenvalues, kind = "stable")
+        cumul = np.cumsum(probabilities[order])
+        value_at_risk = eigenvalues[order][np.searchsorted(cumul, alpha * (1 - 1e-12))]
+        y = np.minimum(eigenvalues - value_at_risk, 0)
+        variance = probabilities.dot(y**2) - probabilities.dot(y)**2
+        return np.sqrt(max(variance, 0) / (alpha**2 * shots))
+    elif cost != 'cost':
+        raise ValueError("Please select a valid cost function")
+    mean = probabilities.dot(eigenvalues)
+    variance = probabilities.dot((eigenvalues - mean)**2)
+    return np.sqrt(variance / shots)
+
+
+# Cost function of a counts dictionary
+def counts_cost(counts, weights, cost, alpha = 0.5, ising = None, cache = None):
+    """Returns the 'cost' (mean eigenvalue) or 'cvar' cost
+    function of a counts dictionary (see 'cost_function_cobyla').
+    """
+    if cost == 'cost':
+        return cost_function_C(counts, weights, ising, cache)
+    elif cost == 'cvar':
+        return cv_a_r(counts, weights, alpha, ising, cache)
+    else:
+        raise ValueError("Please select a valid cost function")
+
+
+# The "infinite shots" mode
+def is_exact(shots):
+    """True if shots asks for the exact (statevector) cost function."""
+    return shots is None or (isinstance(shots, str) and shots == 'exact')
+
+
+# Probabilities of the computational basis states of a circuit
+def exact_probabilities(template, params):
+    """Returns the probabilities of the 2^n basis states of the
+    'CircuitTemplate' with angles params, from its statevector.
+    Entry s is the probability of measuring the bitstring format(s, '0nb').
+    """
+    circuit = template.bind(params).remove_final_measurements(inplace = False)
+    return Statevector(circuit).probabilities()
+
+
+# Energy diagonals already computed in this process (2^n floats each:
+# only the most recent problems are kept)
+exact_energy_tables = OrderedDict()
+exact_energy_tables_capacity = 4
+
+def exact_energies(weights, fix_vertex = None, ising = None, cache = None):
+    """Returns the energies of the basis states of a circuit, in the
+    order of 'exact_probabilities'.
+
+    Without fix_vertex, entry s is the energy of format(s, '0nb'); with
+    fix_vertex, the '0' of the fixed vertex is inserted in each bitstring
+    (see 'expand_counts'). The full table of 'EnergyCache' is used if
+    available, otherwise the table is computed once and kept for the
+    last few problems (see 'cached_value').
+    """
+    if cache is not None and cache.table is not None:
+        table = cache.table
+    else:
+        table = cached_value(exact_energy_tables, problem_key(weights, ising is not None),
+                             lambda: energy_table(np.asarray(weights), ising),
+                             exact_energy_tables_capacity)
+    if fix_vertex is None:
+        return table
+
+    # insert a 0 at bit n-1-fix_vertex of the state index
+    n = len(weights)
+    low = n - 1 - fix_vertex
+    states = np.arange(2**(n-1))
+    return table[((states >> low) << (low + 1)) | (states & ((1 << low) - 1))]
+
+
+# Exact cost function from the probabilities
+def exact_cost(probabilities, energies, cost, alpha = 0.5):
+    """Returns the exact 'cost' (mean eigenvalue) or 'cvar' cost function
+    of a distribution given the probabilities and energies of the states.
+    """
+    if cost == 'cost':
+        return probabilities.dot(energies)
+    elif cost == 'cvar':
+        return cvar_from_distribution(energies, probabilities, alpha)
+    else:
+        raise ValueError("Please select a valid cost function")
+
+
+# Evaluate many parameter vectors with a single job
+def cost_function_batch(params_list,
+                        weights,
+                        n_qbits,
+                        depth,
+                        shots,
+                        cost,
+                        algorithm    = "VQE",
+                        alpha        = 0.5,
+                        backend_name = 'qasm_simulator',
+                        fix_vertex   = None,
+                        ising        = None,
+                        cache        = None,
+                        session      = None):
+    """Returns the ndarray of the cost functions of many parameter vectors.
+
+    params_list: 2-D array, one parameter vector per row,
+    the other arguments are the ones of 'cost_function_cobyla'
+    (including the exact mode shots = None or 'exact').
+
+    All the circuits are bound to the same transpiled template and
+    submitted as a single multi-experiment job, so the job overhead is
+    paid once. Useful for population-based optimizers, gradient
+    estimates and landscape scans.
+    """
+    params_list = np.atleast_2d(params_list)
+
+    if is_exact(shots):
+        energies = exact_energies(weights, fix_vertex, ising, cache)
+        probabilities = circuit_probabilities(params_list, weights, n_qbits, depth, algorithm,
+                                              fix_vertex, ising, backend_name)
+        return np.array([exact_cost(p, energies, cost, alpha) for p in probabilities])
+
+    if session is None:
+        session = backend_session(backend_name)
+
+    counts_list = circuit_counts(params_list, weights, n_qbits, depth, shots, algorithm,
+                                 fix_vertex, ising, session)
+
+    return np.array([counts_cost(counts, weights, cost, alpha, ising, cache)
+                     for counts in counts_list])
+
+
+# Probabilities of the basis states of a circuit
+def circuit_probabilities(params, 
+                          weights, 
+                          n_qbits, 
+                          depth, 
+                          algorithm    = "VQE",
+                          fix_vertex   = None,
+                          ising        = None,
+                          backend_name = 'qasm_simulator'):
+    """Returns the probabilities of the basis states of the circuit
+    (entry s: bitstring format(s, '0nb') of the circuit qbits).
+
+    params: parameter vector, or 2-D array of them (one row each:
+    a 2-D array of probabilities is returned),
+    backend_name: with 'numpy_simulator' the circuit is simulated by
+    'VQE_probabilities' or 'QAOA_probabilities' (no qiskit needed), otherwise the statevector
+    of the 'circuit_template' is computed by qiskit,
+    the other arguments are the ones of 'cost_function_cobyla'.
+    """
+    n_circuit = circuit_qbits(n_qbits, fix_vertex)
+    if backend_name == 'mps_simulator':
+        raise ValueError("The 'mps_simulator' backend can only sample the circuit")
+    if backend_name == 'numpy_simulator':
+        if algorithm == "VQE":
+            return VQE_probabilities(params, n_circuit, depth)
+        elif algorithm == "QAOA":
+            return QAOA_probabilities(params, weights, depth, fix_vertex, ising)
+        raise ValueError("Please select a valid algorithm")
+
+    template = circuit_template(algorithm, n_qbits, depth, weights, fix_vertex, ising)
+    if np.ndim(params) == 2:
+        return np.array([exact_probabilities(template, row) for row in params])
+    return exact_probabilities(template, params)
+
+
+# Measure a circuit
+def circuit_counts(params, 
+                   weights, 
+                   n_qbits, 
+                   depth, 
+                   shots, 
+                   algorithm  = "VQE",
+                   fix_vertex = None,
+                   ising      = None,
+                   session    = None):
+    """Returns the counts dictionary of shots measurements of the circuit
+    with angles params (a list of dictionaries if params is 2-D), with
+    the fixed vertex inserted back (see 'expand_counts').
+
+    On the 'numpy_simulator' session the probabilities are computed with
+    NumPy (once per parameter vector, see 'ShotEmulator') and sampled, on the 'mps_simulator' session the VQE ansatz is
+    simulated as an MPS and sampled; otherwise the transpiled
+    'circuit_template' is run.
+    """
+    if session is None:
+        session = backend_session()
+
+    if session.backend_name == 'mps_simulator':
+        if algorithm != "VQE":
+            raise ValueError("The 'mps_simulator' backend only supports VQE")
+        n_circuit = circuit_qbits(n_qbits, fix_vertex)
+        if np.ndim(params) == 2:
+            return [expand_counts(session.run_mps(row, n_circuit, depth, shots), fix_vertex) for row in params]
+        return expand_counts(session.run_mps(params, n_circuit, depth, shots), fix_vertex)
+
+    if session.backend_name == 'numpy_simulator':
+        if np.ndim(params) == 2:
+            probabilities = circuit_probabilities(params, weights, n_qbits, depth, algorithm,
+                                                  fix_vertex, ising, session.backend_name)
+            return [expand_counts(session.sample_counts(p, shots), fix_vertex) for p in probabilities]
+        # the distribution of a parameter vector is only computed once
+        session.n_jobs += 1
+        return session.emulator(weights, n_qbits, depth, algorithm, fix_vertex, ising).counts(params, shots)
+
+    # the circuit structure is built once, only the angles change
+    template = circuit_template(algorithm, n_qbits, depth, weights, fix_vertex, ising)
+    result = session.run_template(template, params, shots)
+    if np.ndim(params) == 2:
+        return [expand_counts(result.get_counts(k), fix_vertex) for k in range(len(params))]
+    return expand_counts(result.get_counts(), fix_vertex)
+
+
+# NumPy simulation of the VQE ansatz
+def VQE_statevector(theta, n, depth):
+    """Returns the statevector of 'VQE_circuit' (before the measurements)
+    computed with NumPy.
+
+    theta: the (depth+1) * n rotation angles, or a 2-D array with one
+    set of angles per row: the statevectors of all of them are
+    evolved together along the leading axis,
+    n: number of qbits,
+    depth: number of layers.
+
+    The amplitudes of RY and CZ gates stay real. Entry s of the
+    statevector is the amplitude of the bitstring format(s, '0nb')
+    (qbit q is bit q of s, as in qiskit). The RY gates are applied in
+    place on a (batch, 2^(n-q-1), 2, 2^q) view of the state, and each
+    layer of CZ gates is a single multiplication by a +-1 mask.
+    """
+    theta = np.asarray(theta, dtype = float)
+    single = theta.ndim == 1
+    theta = theta.reshape(len(theta) if not single else 1, -1)
+    if theta.shape[1] != ((depth+1) * n):
+        raise ValueError("Theta cannot be reshaped as a (depth+1 x n) matrix")
+    theta = theta.reshape(-1, depth + 1, n)
+    batch = len(theta)
+
+    state = np.zeros((batch, 2**n))
+    state[:, 0] = 1
+
+    # the CZ chain gives a -1 for each pair of neighbouring qbits both in |1>
+    if depth > 0:
+        bits = bits_from_integers(np.arange(2**n), n)
+        cz_mask = 1 - 2 * (np.sum(bits[:, :-1] & bits[:, 1:], axis = 1) % 2).astype(float)
+
+    for j in range(depth + 1):
+        if j > 0:
+            state *= cz_mask
+        for q in range(n):
+            apply_ry(state, theta[:, j, q], q, n)
+
+    if single:
+        return state[0]
+    return state
+
+
+# RY rotation of one qbit of a batch of real statevectors
+def apply_ry(state, angles, q, n):
+    """Applies in place RY(angles[b]) on qbit q of state[b], for each b."""
+    view = state.reshape(len(state), 2**(n-q-1), 2, 2**q)
+    cos = np.cos(angles / 2)[:, None, None]
+    sin = np.sin(angles / 2)[:, None, None]
+    zero = view[:, :, 0, :].copy()
+    one  = view[:, :, 1, :]
+    view[:, :, 0, :] *= cos
+    view[:, :, 0, :] -= sin * one
+    one *= cos
+    one += sin * zero
+
+
+# Probabilities of the VQE ansatz
+def VQE_probabilities(theta, n, depth):
+    """Returns the probabilities of the basis states of 'VQE_circuit'
+    (see 'VQE_statevector' for the arguments and the ordering).
+    """
+    return VQE_statevector(theta, n, depth)**2
+
+
+# NumPy simulation of the QAOA circuit
+def QAOA_statevector(gamma_beta, QUBO, depth, fix_vertex = None, ising = None):
+    """Returns the statevector of 'QAOA_circuit' (before the measurements)
+    computed with NumPy.
+
+    gamma_beta: the angles of 'QAOA_circuit', or a 2-D array with one
+    set of angles per row (evolved together along the leading axis),
+    QUBO, depth, fix_vertex, ising: see 'QAOA_circuit'.
+
+    Each cost layer is diagonal: it is a single elementwise multiplication
+    by exp(i gamma D), where the phases D are computed once per QUBO
+    (see 'QAOA_phases'). The RX mixer is applied with one butterfly
+    update per qbit, so each evaluation costs O(depth * n * 2^n).
+    Entry s is the amplitude of the bitstring format(s, '0nb').
+    """
+    gamma_beta = np.asarray(gamma_beta, dtype = float)
+    single = gamma_beta.ndim == 1
+    gamma_beta = np.atleast_2d(gamma_beta)
+
+    phases = QAOA_phases(QUBO, fix_vertex, ising)
+    n = int(np.log2(len(phases)))
+    if gamma_beta.shape[1] != 2*depth + n:
+        raise ValueError("'gamma_beta' parameter length must be equal to twice 'depth' parameter plus the number of qbits")
+    gamma = gamma_beta[:, 0:depth]
+    beta  = gamma_beta[:, depth:2*depth]
+    theta = gamma_beta[:, 2*depth:2*depth + n]
+
+    state = np.zeros((len(gamma_beta), 2**n), dtype = complex)
+    state[:, 0] = 1
+    for q in range(n):
+        apply_ry(state, theta[:, q], q, n)
+
+    for k in range(depth):
+        state *= np.exp(1j * gamma[:, k, None] * phases)
+        for q in range(n):
+            apply_rx(state, 2*beta[:, k], q, n)
+
+    if single:
+        return state[0]
+    return state
+
+
+# RX rotation of one qbit of a batch of statevectors
+def apply_rx(state, angles, q, n):
+    """Applies in place RX(angles[b]) on qbit q of state[b], for each b."""
+    view = state.reshape(len(state), 2**(n-q-1), 2, 2**q)
+    cos = np.cos(angles / 2)[:, None, None]
+    sin = np.sin(angles / 2)[:, None, None]
+    zero = view[:, :, 0, :].copy()
+    one  = view[:, :, 1, :]
+    view[:, :, 0, :] *= cos
+    view[:, :, 0, :] -= 1j * sin * one
+    one *= cos
+    one -= 1j * sin * zero
+
+
+# Phases of the cost layers already computed in this process (2^n
+# floats each: only the most recent problems are kept)
+QAOA_phase_tables = OrderedDict()
+QAOA_phase_tables_capacity = 4
+
+def QAOA_phases(QUBO, fix_vertex = None, ising = None):
+    """Returns the phases D of the basis states of the circuit such that
+    a cost layer of 'QAOA_circuit' multiplies the statevector by
+    exp(i gamma D). They are summed from the gates of 'QAOA_cost_terms'
+    and computed only once for the last few QUBO matrices (see 'cached_value').
+    """
+    Q = np.asarray(QUBO)
+
+    def build():
+        n = circuit_qbits(len(Q), fix_vertex)
+        bits = bits_from_integers(np.arange(2**n), n).astype(float)
+        phases = np.zeros(2**n)
+        for gate, coefficient, qbits in QAOA_cost_terms(Q, fix_vertex, ising):
+            if gate == "u1":
+                phases += coefficient * bits[:, qbits[0]]
+            elif gate == "cu1":
+                phases += coefficient * bits[:, qbits[0]] * bits[:, qbits[1]]
+            elif gate == "rz":
+                phases -= coefficient / 2 * (1 - 2*bits[:, qbits[0]])
+            elif gate == "rzz":
+                phases -= coefficient / 2 * (1 - 2*bits[:, qbits[0]]) * (1 - 2*bits[:, qbits[1]])
+        return phases
+    return cached_value(QAOA_phase_tables, problem_key(Q, fix_vertex, ising is not None),
+                        build, QAOA_phase_tables_capacity)
+
+
+# Probabilities of the QAOA circuit
+def QAOA_probabilities(gamma_beta, QUBO, depth, fix_vertex = None, ising = None):
+    """Returns the probabilities of the basis states of 'QAOA_circuit'
+    (see 'QAOA_statevector' for the arguments and the ordering).
+    """
+    return np.abs(QAOA_statevector(gamma_beta, QUBO, depth, fix_vertex, ising))**2
+
+
+# Exact cost function and its derivatives with respect to the probabilities
+def cost_weights(probabilities, energies, cost, alpha = 0.5):
+    """Returns the exact cost function of a distribution (see 'exact_cost')
+    and its derivatives with respect to the probabilities of the states.
+
+    'cost': the derivatives are the energies.
+    'cvar': (E_s - E_K) / alpha for the states below the eigenvalue E_K
+    crossing alpha, 0 for the others.
+    """
+    value = exact_cost(probabilities, energies, cost, alpha)
+    if cost == 'cost':
+        return value, energies
+    order = np.argsort(energies, kind = "stable")
+    crossing = min(np.searchsorted(np.cumsum(probabilities[order]), alpha), len(order) - 1)
+    return value, np.minimum(energies - energies[order[crossing]], 0) / alpha
+
+
+# Gradient of the VQE cost function with the adjoint method
+def VQE_cost_gradient(theta, n, depth, energies, cost, alpha = 0.5):
+    """Returns the exact cost function of the VQE ansatz (see
+    'VQE_statevector') and its gradient with respect to theta.
+
+    energies: the energies of the basis states (see 'exact_energies'),
+    cost, alpha: the cost function (see 'exact_cost').
+
+    Adjoint method: after the forward simulation, the state and the
+    vector lambda = G |psi> (G: derivatives of the cost function with
+    respect to the probabilities, see 'cost_weights') are evolved back
+    gate by gate, and each derivative is 2 Re <lambda| dU psi>.
+    The whole gradient costs about three evaluations.
+    """
+    theta = np.asarray(theta, dtype = float).reshape(depth + 1, n)
+    state = VQE_statevector(theta.ravel(), n, depth)[None, :].copy()
+    value, weights = cost_weights(state[0]**2, energies, cost, alpha)
+    adjoint = weights * state
+
+    if depth > 0:
+        bits = bits_from_integers(np.arange(2**n), n)
+        cz_mask = 1 - 2 * (np.sum(bits[:, :-1] & bits[:, 1:], axis = 1) % 2).astype(float)
+
+    gradient = np.zeros((depth + 1, n))
+    for j in range(depth, -1, -1):
+        for q in range(n-1, -1, -1):
+            # d RY / d theta = -i Y / 2 RY
+            psi = state.reshape(2**(n-q-1), 2, 2**q)
+            lam = adjoint.reshape(2**(n-q-1), 2, 2**q)
+            gradient[j, q] = np.sum(lam[:, 1, :] * psi[:, 0, :] - lam[:, 0, :] * psi[:, 1, :])
+            apply_ry(state, -theta[j, q:q+1], q, n)
+            apply_ry(adjoint, -theta[j, q:q+1], q, n)
+        if j > 0:
+            state *= cz_mask
+            adjoint *= cz_mask
+    return value, gradient.ravel()
+
+
+# Gradient of the QAOA cost function with the adjoint method
+def QAOA_cost_gradient(gamma_beta, QUBO, depth, energies, cost, alpha = 0.5,
+                       fix_vertex = None, ising = None):
+    """Returns the exact cost function of the QAOA circuit (see
+    'QAOA_statevector') and its gradient with respect to gamma_beta,
+    with the adjoint method (see 'VQE_cost_gradient').
+    """
+    gamma_beta = np.asarray(gamma_beta, dtype = float)
+    phases = QAOA_phases(QUBO, fix_vertex, ising)
+    n = int(np.log2(len(phases)))
+    gamma = gamma_beta[0:depth]
+    beta  = gamma_beta[depth:2*depth]
+    theta = gamma_beta[2*depth:2*depth + n]
+
+    state = QAOA_statevector(gamma_beta, QUBO, depth, fix_vertex, ising)[None, :].copy()
+    value, weights = cost_weights(np.abs(state[0])**2, energies, cost, alpha)
+    adjoint = weights * state
+
+    gradient = np.zeros(2*depth + n)
+    for k in range(depth-1, -1, -1):
+        for q in range(n-1, -1, -1):
+            # d RX(2 beta) / d beta = -i X RX(2 beta)
+            psi = state.reshape(2**(n-q-1), 2, 2**q)
+            lam = adjoint.reshape(2**(n-q-1), 2, 2**q)
+            gradient[depth + k] += 2 * np.sum(np.conj(lam[:, 0, :]) * psi[:, 1, :] +
+                                              np.conj(lam[:, 1, :]) * psi[:, 0, :]).imag
+            apply_rx(state, -2*beta[k:k+1], q, n)
+            apply_rx(adjoint, -2*beta[k:k+1], q, n)
+        # d exp(i gamma D) / d gamma = i D exp(i gamma D)
+        gradient[k] = -2 * np.sum(np.conj(adjoint[0]) * phases * state[0]).imag
+        state *= np.exp(-1j * gamma[k] * phases)
+        adjoint *= np.exp(-1j * gamma[k] * phases)
+    for q in range(n-1, -1, -1):
+        psi = state.reshape(2**(n-q-1), 2, 2**q)
+        lam = adjoint.reshape(2**(n-q-1), 2, 2**q)
+        gradient[2*depth + q] = np.sum(np.conj(lam[:, 1, :]) * psi[:, 0, :] -
+                                       np.conj(lam[:, 0, :]) * psi[:, 1, :]).real
+        apply_ry(state, -theta[q:q+1], q, n)
+        apply_ry(adjoint, -theta[q:q+1], q, n)
+    return value, gradient
+
+
+# Matrix product state simulation of the VQE ansatz
+def VQE_mps(theta, n, depth, max_bond = 64):
+    """Simulates 'VQE_circuit' (before the measurements) as a matrix
+    product state, for circuits too large for a statevector.
+
+    theta: the (depth+1) * n rotation angles,
+    n: number of qbits,
+    depth: number of layers,
+    max_bond: maximum bond dimension kept after each CZ gate.
+
+    Returns the list of the n real tensors (left bond, qbit, right bond),
+    tensor q being qbit q, in right-canonical form, and the truncation
+    error: the sum of the squared singular values discarded at each CZ
+    gate (relative to the norm of the state), which estimates the
+    infidelity of the state.
+
+    The CZ gates only act on neighbouring qbits: each layer is applied
+    with one left-to-right sweep of two-qbit updates and truncated SVDs.
+    """
+    theta = np.asarray(theta, dtype = float)
+    if len(theta.ravel()) != ((depth+1) * n):
+        raise ValueError("Theta cannot be reshaped as a (depth+1 x n) matrix")
+    theta = theta.reshape(depth + 1, n)
+
+    tensors = [np.array([1., 0.]).reshape(1, 2, 1) for q in range(n)]
+    truncation_error = 0
+
+    for j in range(depth + 1):
+        if j > 0:
+            # the part of the state on the right of each CZ gate must
+            # be right-canonical for the truncation to be optimal
+            mps_right_canonical(tensors)
+            for q in range(n - 1):
+                pair = np.einsum('lar,rbs->labs', tensors[q], tensors[q+1])
+                pair[:, 1, 1, :] *= -1
+                left, right = pair.shape[0], pair.shape[3]
+                u, sv, vt = np.linalg.svd(pair.reshape(2*left, 2*right), full_matrices = False)
+                keep = max(1, min(max_bond, np.count_nonzero(sv > sv[0] * 1e-14)))
+                norm = np.sum(sv**2)
+                truncation_error += np.sum(sv[keep:]**2) / norm
+                sv = sv[:keep] / np.sqrt(np.sum(sv[:keep]**2))
+                tensors[q]   = u[:, :keep].reshape(left, 2, keep)
+                tensors[q+1] = (sv[:, None] * vt[:keep]).reshape(keep, 2, right)
+        for q in range(n):
+            cos, sin = np.cos(theta[j, q] / 2), np.sin(theta[j, q] / 2)
+            ry = np.array([[cos, -sin], [sin, cos]])
+            tensors[q] = np.einsum('ab,lbr->lar', ry, tensors[q])
+
+    mps_right_canonical(tensors)
+    return tensors, truncation_error
+
+
+# Bring an MPS into right-canonical form
+def mps_right_canonical(tensors):
+    """Makes in place all the tensors but the first right-orthonormal,
+    with QR decompositions from the right end of the chain.
+    """
+    for q in range(len(tensors) - 1, 0, -1):
+        left, _, right = tensors[q].shape
+        qr_q, qr_r = np.linalg.qr(tensors[q].reshape(left, 2*right).T)
+        tensors[q]   = qr_q.T.reshape(-1, 2, right)
+        tensors[q-1] = np.einsum('lar,rs->las', tensors[q-1], qr_r.T)
+
+
+# Sample measurements from an MPS
+def mps_sample_counts(tensors, shots, rng = None):
+    """Returns the counts dictionary of shots measurements of a
+    right-canonical MPS (see 'VQE_mps'), in the format of the results
+    of a qiskit job (character k of a bitstring: qbit n-1-k).
+
+    The qbits are sampled one after the other, all the shots together:
+    O(shots * n * max_bond^2).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n = len(tensors)
+    bits = np.zeros((shots, n), dtype = np.uint8)
+    environment = np.ones((shots, 1))
+    for q in range(n):
+        # amplitudes of the two values of the qbit, given the previous ones
+        zero = environment.dot(tensors[q][:, 0, :])
+        one  = environment.dot(tensors[q][:, 1, :])
+        p_zero = np.sum(zero**2, axis = 1)
+        p_one  = np.sum(one**2, axis = 1)
+        outcome = rng.random(shots) * (p_zero + p_one) >= p_zero
+        bits[:, q] = outcome
+        environment = np.where(outcome[:, None], one, zero)
+        environment /= np.sqrt(np.where(outcome, p_one, p_zero))[:, None]
+
+    strings = np.ascontiguousarray(bits[:, ::-1] + ord("0"))
+    states, counts = np.unique(strings.view("S{}".format(n)).ravel(), return_counts = True)
+    return {state.decode() : int(count) for state, count in zip(states, counts)}
+
+
+# Sample measurements from the probabilities of the basis states
+def sample_counts(probabilities, shots, rng = None):
+    """Returns a counts dictionary {bitstring: counts} of shots
+    measurements drawn from the probabilities of the 2^n basis states
+    (entry s: bitstring format(s, '0nb')), in the format of the results
+    of a qiskit job.
+    rng: a numpy random Generator (a new one if None).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    probabilities = np.asarray(probabilities, dtype = float)
+    n = int(np.log2(len(probabilities)))
+    counts = rng.multinomial(shots, probabilities / probabilities.sum())
+    states = np.flatnonzero(counts)
+    return {format(state, '0{}b'.format(n)) : int(counts[state]) for state in states}
+
+
+# Draw measurements of any number of shots from one simulation
+class ShotEmulator:
+    """Emulates the measurements of a circuit from its exact distribution.
+
+    weights, n_qbits, depth, algorithm, fix_vertex, ising: the circuit
+    (see 'cost_function_cobyla'),
+    backend_name: 'numpy_simulator' (NumPy simulators) or any other
+    name for the qiskit statevector (see 'circuit_probabilities'),
+    rng: the numpy random Generator of the draws (a new one if None),
+    capacity: number of distributions kept (least recently used
+    evicted first). Optimizers rarely evaluate the same point twice,
+    and each distribution is 2^n long, so only the last ones are kept.
+
+    The distribution of each parameter vector is simulated once; then
+    any number of shots is drawn with Generator.multinomial and returned
+    in the counts dictionary format (fixed vertex inserted back).
+    'simulations' and 'draws' count the two operations.
+    """
+    def __init__(self, weights, n_qbits, depth, algorithm = "VQE", fix_vertex = None, ising = None,
+                 backend_name = 'numpy_simulator', rng = None, capacity = 2):
+        self.weights      = weights
+        self.n_qbits      = n_qbits
+        self.depth        = depth
+        self.algorithm    = algorithm
+        self.fix_vertex   = fix_vertex
+        self.ising        = ising
+        self.backend_name = backend_name
+        self.rng          = rng if rng is not None else np.random.default_rng()
+        self.capacity     = capacity
+        self.distributions = OrderedDict()
+        self.simulations  = 0
+        self.draws        = 0
+
+    def probabilities(self, params):
+        """Returns the probabilities of the basis states of the circuit
+        with angles params, simulating it only the first time.
+        """
+        key = np.asarray(params, dtype = float).tobytes()
+        if key in self.distributions:
+            self.distributions.move_to_end(key)
+        else:
+            self.simulations += 1
+            self.distributions[key] = circuit_probabilities(params, self.weights, self.n_qbits, self.depth,
+                                                            self.algorithm, self.fix_vertex, self.ising,
+                                                            self.backend_name)
+            while len(self.distributions) > self.capacity:
+                self.distributions.popitem(last = False)
+        return self.distributions[key]
+
+    def counts(self, params, shots):
+        """Returns the counts dictionary of shots measurements."""
+        self.draws += 1
+        return expand_counts(sample_counts(self.probabilities(params), shots, self.rng), self.fix_vertex)
+
+    def sweep(self, params, shots_list):
+        """Returns a dictionary {shots: counts dictionary} with one set of
+        measurements per number of shots, from a single simulation.
+        This is the tool for shot-dependence studies at fixed parameters
+        (e.g. the optimized angles of a run): the optimizations at different
+        shots visit different points and share no distribution.
+        """
+        return {shots : self.counts(params, shots) for shots in shots_list}
+
+    def stats(self):
+        """Returns a dictionary with the simulations, draws and distributions kept."""
+        return {"simulations" : self.simulations,
+                "draws"       : self.draws,
+                "size"        : len(self.distributions)}
+
+
 # Is time a good figure of merit?
 # https://stackoverflow.com/questions/27728483/understanding-the-output-of-scipy-optimize-basinhopping
 
 import time
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
+
+# Simultaneous perturbation stochastic approximation
+def spsa_minimize(batch_function, 
+                  x0, 
+                  maxiter   = 500, 
+                  step      = 0.2, 
+                  c         = 0.1, 
+                  a_alpha   = 0.602, 
+                  c_gamma   = 0.101, 
+                  n_calib   = 5,
+                  seed      = 0):
+    """Minimizes a noisy function with SPSA.
+
+    batch_function: function of a 2-D array of parameter vectors (one
+    per row) returning the ndarray of their costs (see 'cost_function_batch'),
+    x0: initial parameters,
+    maxiter: number of iterations,
+    step: size of the first steps. The gain a is calibrated with n_calib
+    gradient estimates at x0 (one batch) so that the first steps are about
+    step long,
+    c, a_alpha, c_gamma: the perturbation c_k = c/(k+1)^c_gamma and the
+    gain a_k = a/(k+1+A)^a_alpha, with A = maxiter/10,
+    seed: seed of the random perturbations.
+
+    Each iteration evaluates the 2 circuits x_k +- c_k*delta_k in one
+    batch. Returns an OptimizeResult with x, fun (cost of the final x),
+    nfev and nit, plus the time and the circuits of each iteration
+    ('iteration_times', 'iteration_circuits').
+    """
+    rng = np.random.default_rng(seed)
+    x = np.array(x0, dtype = float)
+    A = 0.1 * maxiter
+    iteration_times = []
+    iteration_circuits = []
+    start = time.time()
+
+    # Calibration of the gain with the first perturbation
+    deltas = rng.choice([-1, 1], size = (n_calib, x.size))
+    values = batch_function(np.concatenate((x + c*deltas, x - c*deltas)))
+    magnitude = np.mean(np.abs(values[:n_calib] - values[n_calib:])) / (2*c)
+    a = step * (A + 1)**a_alpha / max(magnitude, 1e-12)
+    nfev = 2 * n_calib
+
+    for k in range(maxiter):
+        c_k = c / (k + 1)**c_gamma
+        a_k = a / (k + 1 + A)**a_alpha
+        delta = rng.choice([-1, 1], size = x.size)
+        values = batch_function(np.array([x + c_k*delta, x - c_k*delta]))
+        x = x - a_k * (values[0] - values[1]) / (2*c_k) * delta
+        nfev += 2
+        iteration_times.append(time.time() - start)
+        iteration_circuits.append(2)
+
+    fun = batch_function(x)[0]
+    nfev += 1
+    return OptimizeResult(x = x, fun = fun, nfev = nfev, nit = maxiter,
+                          iteration_times = iteration_times,
+                          iteration_circuits = iteration_circuits)
+
+
+# Gradient descent with the parameter-shift rule
+def parameter_shift_minimize(batch_function, 
+                             x0, 
+                             maxiter = 100, 
+                             step    = 0.1, 
+                             adam    = False, 
+                             shift   = PI/2,
+                             tol     = 0.0001,
+                             beta1   = 0.9, 
+                             beta2   = 0.999):
+    """Minimizes a function by gradient descent, with the gradient given
+    by the parameter-shift rule:
+    df/dx_i = (f(x + s e_i) - f(x - s e_i)) / (2 sin(s)).
+
+    batch_function: see 'spsa_minimize',
+    x0: initial parameters,
+    maxiter: maximum number of iterations,
+    step: with adam = False, the first step is step long (the learning
+    rate is step / max|gradient at x0|). With adam = True, the Adam
+    learning rate (beta1, beta2: its moment decay rates),
+    shift: the shift s. The rule is exact for the mean cost when each
+    parameter enters a single rotation gate (s = PI/2, e.g. the VQE
+    ansatz); otherwise it is a finite difference estimate,
+    tol: the descent stops when the step is shorter than tol.
+
+    Each iteration evaluates the 2*P shifted circuits (P parameters) in
+    one batch. Returns an OptimizeResult like 'spsa_minimize'.
+    """
+    x = np.array(x0, dtype = float)
+    shifts = shift * np.eye(x.size)
+    m = np.zeros(x.size)
+    v = np.zeros(x.size)
+    rate = None
+    iteration_times = []
+    iteration_circuits = []
+    start = time.time()
+    nfev = 0
+
+    for k in range(maxiter):
+        values = batch_function(np.concatenate((x + shifts, x - shifts)))
+        gradient = (values[:x.size] - values[x.size:]) / (2*np.sin(shift))
+        nfev += 2 * x.size
+        if adam == True:
+            m = beta1*m + (1 - beta1)*gradient
+            v = beta2*v + (1 - beta2)*gradient**2
+            m_hat = m / (1 - beta1**(k + 1))
+            v_hat = v / (1 - beta2**(k + 1))
+            update = step * m_hat / (np.sqrt(v_hat) + 1e-8)
+        else:
+            if rate is None:
+                rate = step / max(np.max(np.abs(gradient)), 1e-12)
+            update = rate * gradient
+        x = x - update
+        iteration_times.append(time.time() - start)
+        iteration_circuits.append(2 * x.size)
+        if np.linalg.norm(update) < tol:
+            break
+
+    fun = batch_function(x)[0]
+    nfev += 1
+    return OptimizeResult(x = x, fun = fun, nfev = nfev, nit = k + 1,
+                          iteration_times = iteration_times,
+                          iteration_circuits = iteration_circuits)
+
 
 def time_vs_shots(shots,
                   weights,
@@ -280,16 +2004,26 @@ def time_vs_shots(shots,
                   alpha = 0.5,
                   theta = 1,
                   algorithm = "VQE",
-                  verbosity = False):
+                  verbosity = False,
+                  fix_vertex = None,
+                  ising = None,
+                  cache = None,
+                  session = None,
+                  optimizer = "COBYLA",
+                  memo = None):
     """Returns the time taken to solve a VQE problem
     as a function of the shots.    
     
     Input parameters:
-    shots: number of evaluations of the circuit state,
+    shots: number of evaluations of the circuit state (None or 'exact'
+    for the exact cost function, see 'cost_function_cobyla'), or a
+    'ShotSchedule' to change them along the optimization, or a
+    'SequentialEstimator' to draw them until the cost is precise enough,
     weights: the original QUBO matrix of the problem,
     n_qbits: number of qbits of the circuit,
     depth: number of layers of the ciruit,
     backend_name: the name of the device where the optimization will be performed,
+    'numpy_simulator' to simulate the circuits with NumPy (see 'circuit_probabilities'),
     final_eval_shots: number of shots for the evaluation of the optimized circuit,
     cost: the cost function to be used. It can be: 
      - 'cost': mean value of all measured eigenvalues
@@ -299,49 +2033,126 @@ def time_vs_shots(shots,
     theta: the ansatz initial parameters. If set to 1, the 
         standard ry ansatz parameters are used,
     algorithm: the optimization algorithm to be used (VQE or QAOA),
-    verbosity: activate/desactivate some control printouts.
+    verbosity: activate/desactivate some control printouts,
+    fix_vertex: if set, this vertex is kept on side 0 and the circuits
+    have n_qbits-1 qbits. The counts returned are still n_qbits long,
+    ising: optional (h, J, offset) Ising form of weights (see 'qubo_to_pauli'),
+    cache: optional 'EnergyCache' bound to weights. It can be shared
+    by several calls on the same problem,
+    session: the 'BackendSession' used for all the circuit evaluations
+    (see 'backend_session'). If not given, the session of backend_name,
+    optimizer: 'COBYLA' (gradient-free) or 'L-BFGS-B'. L-BFGS-B uses the
+    exact gradient of 'cost_function_gradient' and needs shots = None
+    or 'exact'. 'SPSA' (see 'spsa_minimize'), 'param-shift' and
+    'param-shift-adam' (see 'parameter_shift_minimize') submit the
+    circuits of each step as one batch ('cost_function_batch') and need
+    a number of shots (or None/'exact'),
+    memo: optional 'CostMemo' of the COBYLA evaluations (repeated
+    points are not executed again, or pool their shots). It is
+    cleared at the beginning of the run.
     
     Output:
     elapsed_time: time taken for the optimization (in seconds)
     counts: dictionaty the results of the optimization
-    shots: the 'shots' input parameter (it may be useful for analysis)
+    shots: the 'shots' input parameter (it may be useful for analysis),
+    or the label of the 'ShotSchedule' or 'SequentialEstimator'
     n_func_evaluations: number of evaluations of the cost function
     final_eval_shots: shots for the optimal circuit evaluation
     optimal_angles: the theta parameters given by the optimization,
-    final_cost: the cost function of the optimal circuit.
+    final_cost: the cost function of the optimal circuit,
+    info: dictionary with the evaluations of the cost function
+    which executed the circuit ('nfev_executed') and the ones
+    answered by memo ('nfev_cached'), and the total number of
+    circuit evaluations, i.e. the shots summed over the executed
+    evaluations ('circuit_evaluations', NaN in exact mode). With the
+    batched optimizers it also has the time elapsed at the end of each
+    iteration ('iteration_times') and its circuits ('iteration_circuits'),
+    and n_func_evaluations counts all the circuits. It is appended after
+    the other outputs, which keep their positions.
     
     """
+    # Number of qbits actually used by the circuits
+    n_circuit = circuit_qbits(n_qbits, fix_vertex)
+
+    # Every run starts its shot schedule from the beginning
+    if isinstance(shots, (ShotSchedule, SequentialEstimator)):
+        shots.reset()
+
+    # The backend is resolved once for the whole optimization
+    if session is None:
+        session = backend_session(backend_name)
+
     # Do this only if no initial parameters have been given
     if isinstance(theta, (int)):
         if algorithm == "VQE":
             # Create the rotation angles for the ansatz
-            theta_0       = np.repeat(PI/2, n_qbits)
-            theta_0.shape = (1, n_qbits)
-            theta_1       = np.zeros((depth, n_qbits))
+            theta_0       = np.repeat(PI/2, n_circuit)
+            theta_0.shape = (1, n_circuit)
+            theta_1       = np.zeros((depth, n_circuit))
             theta         = np.concatenate((theta_0, theta_1), axis = 0) 
         elif algorithm == "QAOA":
             theta_0 = np.zeros(2*depth)
-            theta_1 = np.repeat(PI/2, n_qbits)
+            theta_1 = np.repeat(PI/2, n_circuit)
             theta   = np.concatenate((theta_0, theta_1), axis = 0) 
+        # The standard parameters are a stationary point of the cost
+        # function (uniform superposition): move away from it a little
+        # so that the gradient is not zero
+        if optimizer in ('L-BFGS-B', 'param-shift', 'param-shift-adam'):
+            theta = theta + 0.1 * np.random.default_rng(0).standard_normal(theta.shape)
     
     # Time starts with the optimization
     start_time = time.time()
 
+    # Cost function (and gradient) to be minimized
+    if optimizer == 'COBYLA':
+        function = cost_function_cobyla
+    elif optimizer == 'L-BFGS-B':
+        function = cost_function_gradient
+    elif optimizer in ('SPSA', 'param-shift', 'param-shift-adam'):
+        if isinstance(shots, (ShotSchedule, SequentialEstimator)):
+            raise ValueError("The batched optimizers need a fixed number of shots")
+        # All the circuits of a step are submitted together
+        def function(params_list):
+            return cost_function_batch(params_list, weights, n_qbits, depth, shots, cost,
+                                       algorithm, alpha, backend_name, fix_vertex,
+                                       ising, cache, session)
+    else:
+        raise ValueError("Please select a valid optimizer")
+    extra_args = ()
+    if memo is not None:
+        if optimizer != 'COBYLA':
+            raise ValueError("'memo' is only used with COBYLA")
+        extra_args = (memo,)
+        memo.clear()
+
     # Classical optimizer tuning
-    res = minimize(fun     = cost_function_cobyla, 
-                   x0      = theta.ravel(),     # the 'params' argument of 'cost_function_cobyla'
-                   method  = 'COBYLA',          # we want to use the COBYLA optimization algorithm
-                   options = {'maxiter': 500},  # maximum number of iterations
-                   tol     = 0.0001,            # tolerance or final accuracy in the optimization 
-                   args    = (weights, 
-                              n_qbits, 
-                              depth, 
-                              shots,
-                              cost,
-                              algorithm,
-                              alpha,
-                              backend_name,
-                              verbosity))    # the arguments of 'cost_function_cobyla', except 'params'
+    if optimizer == 'SPSA':
+        res = spsa_minimize(function, theta.ravel())
+    elif optimizer in ('param-shift', 'param-shift-adam'):
+        # The shift rule is exact for the VQE rotations only
+        res = parameter_shift_minimize(function, theta.ravel(),
+                                       adam  = optimizer == 'param-shift-adam',
+                                       shift = PI/2 if algorithm == "VQE" else 0.1)
+    else:
+        res = minimize(fun     = function, 
+                       x0      = theta.ravel(),     # the 'params' argument of 'cost_function_cobyla'
+                       method  = optimizer,         # COBYLA, or L-BFGS-B with the exact gradient
+                       jac     = optimizer == 'L-BFGS-B',
+                       options = {'maxiter': 500},  # maximum number of iterations
+                       tol     = 0.0001,            # tolerance or final accuracy in the optimization 
+                       args    = (weights, 
+                                  n_qbits, 
+                                  depth, 
+                                  shots,
+                                  cost,
+                                  algorithm,
+                                  alpha,
+                                  backend_name,
+                                  verbosity,
+                                  fix_vertex,
+                                  ising,
+                                  cache,
+                                  session) + extra_args)  # the arguments of 'cost_function_cobyla', except 'params'
 
     # Time stops when the optimization stopshttps://qiskit.org/
     end_time = time.time()
@@ -351,32 +2162,31 @@ def time_vs_shots(shots,
 
     # Number of cost function evaluations during the optimization
     n_func_evaluations = res.nfev
-
-    # Obtain the output distribution using the final parameters
-    # VQE
-    if algorithm == "VQE":
-        optimal_circuit = VQE_circuit(res.x, 
-                                      n_qbits, 
-                                      depth)
-    # QAOA
-    elif algorithm == "QAOA":
-        optimal_circuit = QAOA_circuit(res.x, 
-                                       weights, 
-                                       depth)
-
-    # Define the backend for the evaluation of the optimal circuit
-    # - in case it is a simulator
-    if backend_name == 'qasm_simulator':
-        backend = Aer.get_backend('qasm_simulator')
-    # - in case it is a real quantum device
+    info = {"nfev_executed" : int(n_func_evaluations),
+            "nfev_cached"   : 0}
+    if memo is not None:
+        info["nfev_executed"] = memo.executed
+        info["nfev_cached"]   = memo.cached
+    if "iteration_times" in res:
+        info["iteration_times"]    = res.iteration_times
+        info["iteration_circuits"] = res.iteration_circuits
+
+    # Total number of circuit evaluations
+    if isinstance(shots, (ShotSchedule, SequentialEstimator)):
+        info["circuit_evaluations"] = shots.total_shots
+        info["shots_history"]       = list(shots.history)
+        shots = shots.label()
+    elif is_exact(shots):
+        info["circuit_evaluations"] = np.nan
     else:
-        provider = IBMQ.load_account()
-        backend = provider.get_backend(backend_name)
+        info["circuit_evaluations"] = info["nfev_executed"] * shots
 
     # Get the results from the circuit with the optimized parameters    
-    counts = execute(optimal_circuit, 
-                     backend, 
-                     shots = final_eval_shots).result().get_counts(optimal_circuit)
+    counts = circuit_counts(res.x, weights, n_qbits, depth, final_eval_shots, 
+                            algorithm, fix_vertex, ising, session)
+
+    # The distributions of this run are not needed anymore
+    session.clear_emulators()
     
     # The optimized rotation angles
     optimal_angles = res.x
@@ -384,7 +2194,7 @@ def time_vs_shots(shots,
     # The cost function of the optimal circuit
     final_cost = res.fun
     
-    return elapsed_time, counts, shots, n_func_evaluations, final_eval_shots, optimal_angles, final_cost
+    return elapsed_time, counts, shots, n_func_evaluations, final_eval_shots, optimal_angles, final_cost, info
 
 
 # Plot function definition
@@ -488,25 +2298,20 @@ def fit_1_exp(x, a, b):
 # results_dict: the eigenstate-freq dictionary returned by 'time_vs_shots'
 # weights: the original QUBO matrix
 def best_candidate_finder(results_dict, 
-                          weights):
+                          weights,
+                          cache = None):
         
     # the eigenstates obtained by the evaluation of the circuit
     eigenstates = list(results_dict.keys())
         
-    # initialize the cost function
-    min_cost = 0
-    best_candidate = 0
-    
-    for k in range(len(eigenstates)):
-        # ndarray of the digits extracted from the eigenstate string 
-        x = np.array([int(num) for num in eigenstates[k]])
-        # Cost function of to the k-th eigenstate
-        cost = x.dot(weights.dot(1-x))
-        if cost > min_cost:
-            min_cost = cost
-            best_candidate = eigenstates[k]
-    
-    return best_candidate
+    # the cost function of all the eigenstates at once
+    eigenvalues, _ = counts_energies(results_dict, weights, cache = cache)
+    
+    # the first eigenstate with the largest cut, if positive
+    k = np.argmin(eigenvalues)
+    if eigenvalues[k] < 0:
+        return eigenstates[k]
+    return 0
         
 
 # Function to compute F_opt
@@ -514,7 +2319,8 @@ def F_opt_finder(results_obj,
                  n_shots,
                  weights,
                  opt_sol,
-                 n_eigenstates = 1000):
+                 n_eigenstates = 1000,
+                 cache = None):
     """Returns the fraction of optimal solutions.
     
     Given the object returned by 'time_vs_shots',
@@ -526,101 +2332,154 @@ def F_opt_finder(results_obj,
     n_shots: the 'number of shots' to investigate,
     W: the original QUBO matrix,
     opt_sol: list of the optimal solutions to the problem,
-    n_eigenstates: maximum number of eigenstates in a solution.
-    """
-    # Initialize the counter of repetitions for the
-    # selected number of shots
-    N_rep = 0
-    # Initialize the counter of best candidates which 
-    # are optimal solutions    
-    N_bc  = 0
-    # Scan all the entries of the object
-    for res in results_obj:
-        # Select only the entries corresponding to 
-        # the selected number of shots
-        if res[2] == n_shots:
-            # If the number of shots is the one we want to check,
-            # sum 1 to the number of repetitions
-            N_rep += 1
-            # Find best candidate
-            bc = best_candidate_finder(res[1], weights)
-            # best candidate must contain the optimal solution
-            if bc in opt_sol:
-                # best candidate must have less than 'n_eigenstates' eigenstates
-                if len(res[1]) < n_eigenstates:
-                    N_bc += 1
-    # Initialize output value
-    F_opt = 0
-    # If N_rep is not 0, return the fraction of best candidates
-    # which are also optimal solutions
-    if N_rep != 0:
-        F_opt = N_bc / N_rep
+    n_eigenstates: maximum number of eigenstates in a solution,
+    cache: optional 'EnergyCache' bound to weights.
+    """
+    return F_opt_all_shots(results_obj, [n_shots], weights, opt_sol,
+                           n_eigenstates, cache)[0]
+
+
+# Best candidates of many solutions at once
+def best_candidates_finder(results_list, weights, cache = None):
+    """Returns the list of the best candidates of a list of
+    eigenstate-freq dictionaries (see 'best_candidate_finder').
+
+    The eigenstates of all the dictionaries are converted and
+    evaluated in one batch (through 'cache', if given).
+    """
+    eigenstates = [key for results in results_list for key in results]
+    lengths = np.array([len(results) for results in results_list])
+    if len(eigenstates) == 0:
+        return [0] * len(results_list)
+    x = strings_to_bits(eigenstates)
+    if cache is None:
+        eigenvalues = bits_energies(x, weights)
     else:
-        print("The number of shots selected is not present")
+        eigenvalues = cache.lookup(x)
+
+    # first eigenstate with the lowest eigenvalue of each solution
+    non_empty = np.flatnonzero(lengths > 0)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[non_empty]
+    minima = np.minimum.reduceat(eigenvalues, starts)
+    solution = np.repeat(np.arange(len(non_empty)), lengths[non_empty])
+    at_minimum = np.flatnonzero(eigenvalues == minima[solution])
+    first = at_minimum[np.searchsorted(solution[at_minimum], np.arange(len(non_empty)))]
+
+    best_candidates = [0] * len(results_list)
+    for k, index, minimum in zip(non_empty, first, minima):
+        if minimum < 0:
+            best_candidates[k] = eigenstates[index]
+    return best_candidates
+
+
+# Function to compute F_opt for many numbers of shots
+def F_opt_all_shots(results_obj,
+                    shot_list,
+                    weights,
+                    opt_sol,
+                    n_eigenstates = 1000,
+                    cache = None):
+    """Returns the ndarray of the fractions of optimal solutions
+    for each number of shots in shot_list (see 'F_opt_finder').
+
+    The object is scanned once: the best candidates of all the
+    repetitions are computed in one batch and then grouped by shots.
+    """
+    # object array: the shots may also be 'ShotSchedule' or
+    # 'SequentialEstimator' labels
+    shots = np.array([res[2] for res in results_obj], dtype = object)
+    best_candidates = best_candidates_finder([res[1] for res in results_obj], weights, cache)
+
+    # best candidate must contain the optimal solution and
+    # have less than 'n_eigenstates' eigenstates
+    optimal = set(opt_sol)
+    good = np.array([bc in optimal and len(res[1]) < n_eigenstates
+                     for bc, res in zip(best_candidates, results_obj)], dtype = bool)
+
+    F_opt = np.zeros(len(shot_list))
+    for i, n_shots in enumerate(shot_list):
+        selected = shots == n_shots
+        N_rep = selected.sum()
+        # If N_rep is not 0, return the fraction of best candidates
+        # which are also optimal solutions
+        if N_rep != 0:
+            F_opt[i] = good[selected].sum() / N_rep
+        else:
+            print("The number of shots selected is not present")
     return F_opt
 
 
 # CVaR definition
-def cv_a_r(results, weights, alpha):
+def cv_a_r(results, weights, alpha, ising = None, cache = None):
     """ The function computes the conditional value at risk of a solution.
     Inputs:
     results: the eigenstates-abundances dictionary returned by the optimization,
     weights: the original QUBO matrix,
     alpha: the parameter of CVaR. Alpha c (0,1] and represents the fraction of
-    eigenstates considered in the computation.
+    eigenstates considered in the computation. It can also be an array of
+    alphas: the eigenvalues are then computed once and an ndarray of CVaRs
+    is returned,
+    ising: optional (h, J, offset) Ising form of weights (see 'qubo_to_pauli'),
+    cache: optional 'EnergyCache' bound to weights.
     
     The computation of CVaR considers first the eigenstates associated to the lowest
-    eigenvalues and moves to eigenstates associated to increasing eigenvalues.
+    eigenvalues and moves to eigenstates associated to increasing eigenvalues
+    (see 'cvar_from_distribution').
     """
-    # the eigenstates obtained by the evaluation of the circuit
-    eigenstates = list(results.keys())
+    # the eigenvalues of the eigenstates obtained by the evaluation
+    # of the circuit and how many times each of them has been sampled
+    eigenvalues, abundancies = counts_energies(results, weights, ising, cache)
 
-    # create ndarray of eigenvalues
-    eigenvalues = np.array([])
-    for k in range(len(eigenstates)):
-        # ndarray of the digits extracted from the eigenstate string 
-        x = np.array([int(num) for num in eigenstates[k]])
-        eigenvalues = np.append(eigenvalues, -x.dot(weights.dot(1-x)))
-    
-    # number of shots 
-    shots = sum(results.values())
+    return cvar_from_distribution(eigenvalues, abundancies / abundancies.sum(), alpha)
 
-    # Create a dataframe to manage all the variables used
-    # Start from the 'results' dictionary
-    cv_df = pd.DataFrame.from_dict(results, orient = 'index')
-    cv_df.reset_index(level=0, inplace=True)
-    cv_df.columns = ["eigenstate", "abundance"]
-    cv_df["abundance"] = cv_df.abundance / shots
-    
-    # Adding eigenvalues
-    cv_df['eigenvalue'] = eigenvalues
-    
-    # Sort by eigenvalues (smaller first)
-    cv_df.sort_values(by = ["eigenvalue"], inplace = True)
-    
-    # Define 'cumulative eigenstate abundace': we want to sum
-    # term until cumul_abund is less or equal to alpha
-    cv_df["cumul_abund"] = np.cumsum(cv_df["abundance"])
 
-    # We are overstimating the abundace of the last term of CVaR
-    # by this quantity    
-    diff = cv_df[cv_df["cumul_abund"] > 0.5].iloc[0].cumul_abund - alpha
-    # corrected value
-    new_abundance = cv_df[cv_df["cumul_abund"] > 0.5].iloc[0].abundance - diff
-    
-    # location of the value to be corrected
-    qq = cv_df[cv_df["cumul_abund"] > 0.5].iloc[0]    
-    # corrected abundance value
-    cv_df.at[qq.name, "abundance"]   = new_abundance
-    cv_df.at[qq.name, "cumul_abund"] = 0.5
+# CVaR of a discrete distribution of eigenvalues
+def cvar_from_distribution(eigenvalues, probabilities, alpha):
+    """Returns the mean of the lowest eigenvalues carrying a total
+    probability alpha. The eigenvalue crossing alpha only contributes
+    with the fraction of its probability needed to reach alpha.
 
-    # Actual CVaR computation
-    cv_df["cv"] = (cv_df["abundance"] * cv_df["eigenvalue"]) / alpha   
-    cv_df["cumul_cv"] = np.cumsum(cv_df["cv"])
+    eigenvalues: ndarray of the eigenvalues,
+    probabilities: ndarray of their probabilities (summing to 1),
+    alpha: the CVaR parameter, in (0,1], or an array of them
+    (an ndarray of CVaRs is returned in that case).
 
-    # CVaR value
-    cvar = cv_df.at[qq.name, "cumul_cv"]
-    
+    Only the lowest eigenvalues are selected with np.argpartition
+    and sorted: the whole distribution is never sorted unless needed.
+    """
+    eigenvalues   = np.asarray(eigenvalues, dtype = float)
+    probabilities = np.asarray(probabilities, dtype = float)
+    alphas = np.atleast_1d(np.asarray(alpha, dtype = float))
+    if np.any(alphas <= 0) or np.any(alphas > 1):
+        raise ValueError("'alpha' must be in (0,1]")
+    alpha_max = alphas.max()
+
+    # Select the k lowest eigenvalues, increasing k until they carry
+    # at least a probability alpha_max
+    n_states = len(eigenvalues)
+    k = min(n_states, max(1, int(np.ceil(alpha_max * n_states))))
+    while True:
+        if k < n_states:
+            lowest = np.argpartition(eigenvalues, k - 1)[:k]
+        else:
+            lowest = np.arange(n_states)
+        if k == n_states or probabilities[lowest].sum() >= alpha_max:
+            break
+        k = min(n_states, 2*k)
+    lowest = lowest[np.argsort(eigenvalues[lowest], kind = "stable")]
+    values = eigenvalues[lowest]
+    probs  = probabilities[lowest]
+
+    # Eigenvalue crossing each alpha and its fractional contribution
+    cumul_prob = np.cumsum(probs)
+    cumul_cv   = np.cumsum(probs * values)
+    last = np.minimum(np.searchsorted(cumul_prob, alphas), k - 1)
+    prob_before = np.where(last > 0, cumul_prob[last - 1], 0)
+    cv_before   = np.where(last > 0, cumul_cv[last - 1], 0)
+    cvar = (cv_before + (alphas - prob_before) * values[last]) / alphas
+
+    if np.ndim(alpha) == 0:
+        return cvar[0]
     return cvar
 
 
@@ -734,51 +2593,344 @@ def random_graph_producer(n_vert, n_edge, seed = 2000, verbosity = False):
     return Q
 
 
+# Expected cut of the depth-1 QAOA circuit in closed form
+def QAOA_p1_expectation(QUBO, gamma, beta):
+    """Returns the expected cut of the depth-1 QAOA state
+    exp(-i beta sum X) exp(-i gamma H) |+>^n, where H = sum J_uv z_u z_v
+    is the Ising form of QUBO (see 'qubo_to_pauli'), and its gradient
+    with respect to (gamma, beta).
+
+    This is the state of 'QAOA_circuit(..., ising = qubo_to_pauli(QUBO))'
+    with depth 1 and all theta = PI/2. QUBO must be symmetric (no local
+    fields), dense or scipy.sparse, e.g. from 'random_graph_producer'.
+
+    For each edge,
+    <z_u z_v> = sin(4 beta)/2 sin(2 gamma J_uv) [prod_w cos(2 gamma J_uw) + prod_w cos(2 gamma J_vw)]
+              - sin(2 beta)^2/2 [prod_w cos(2 gamma (J_uw + J_vw)) - prod_w cos(2 gamma (J_uw - J_vw))]
+    with w != u, v. Only the neighbours of u and v contribute to the
+    products, so the cost is O(sum over the edges of the degrees of their
+    vertices), with no statevector: it works for thousands of vertices.
+    """
+    h, J, offset = qubo_to_pauli(sparse.csr_matrix(QUBO))
+    if np.any(np.abs(h) > 1e-12):
+        raise ValueError("The closed form needs a symmetric QUBO matrix (no local fields)")
+    n = len(h)
+
+    # the edges (u < v) and the symmetric couplings of each vertex
+    J = J.tocoo()
+    edges_u, edges_v, edges_J = J.row, J.col, J.data
+    full = sparse.csr_matrix((np.concatenate((edges_J, edges_J)),
+                              (np.concatenate((edges_u, edges_v)), np.concatenate((edges_v, edges_u)))),
+                             shape = (n, n))
+    full.sort_indices()
+    degrees = np.diff(full.indptr)
+    # key u * n + w of each coupling, sorted, to look up J_uw
+    keys = np.repeat(np.arange(n), degrees) * n + full.indices
+
+    def coupling(u, w):
+        """J_uw for the arrays u, w (0 if not coupled)."""
+        position = np.minimum(np.searchsorted(keys, u * n + w), len(keys) - 1)
+        found = keys[position] == u * n + w
+        return np.where(found, full.data[position], 0), found
+
+    def neighbours(vertices):
+        """Edge index, neighbour and coupling of each neighbour of vertices[e]."""
+        counts = degrees[vertices]
+        edge = np.repeat(np.arange(len(vertices)), counts)
+        start = np.repeat(full.indptr[vertices] - np.cumsum(counts) + counts, counts)
+        position = start + np.arange(counts.sum())
+        return edge, full.indices[position], full.data[position]
+
+    def product(edge, coefficients):
+        """prod of cos(gamma * coefficients) per edge and its derivative."""
+        cos = np.cos(gamma * coefficients)
+        cos = np.where(cos == 0, 1e-300, cos)
+        log_abs = np.bincount(edge, np.log(np.abs(cos)), minlength = len(edges_u))
+        negative = np.bincount(edge, cos < 0, minlength = len(edges_u))
+        value = np.where(negative % 2 == 1, -1., 1.) * np.exp(log_abs)
+        derivative = value * np.bincount(edge, -coefficients * np.tan(gamma * coefficients),
+                                         minlength = len(edges_u))
+        return value, derivative
+
+    # neighbours w of u (w != v), with J_uw and J_vw
+    edge_u, w_u, J_uw = neighbours(edges_u)
+    keep = w_u != edges_v[edge_u]
+    edge_u, w_u, J_uw = edge_u[keep], w_u[keep], J_uw[keep]
+    J_vw, _ = coupling(edges_v[edge_u], w_u)
+    # neighbours w of v (w != u), with a flag for the common ones
+    edge_v, w_v, J_vw_v = neighbours(edges_v)
+    keep = w_v != edges_u[edge_v]
+    edge_v, w_v, J_vw_v = edge_v[keep], w_v[keep], J_vw_v[keep]
+    _, common = coupling(edges_u[edge_v], w_v)
+
+    P_u, dP_u = product(edge_u, 2*J_uw)
+    P_v, dP_v = product(edge_v, 2*J_vw_v)
+    only_v = ~common
+    edge_t = np.concatenate((edge_u, edge_v[only_v]))
+    P_plus, dP_plus   = product(edge_t, 2*np.concatenate((J_uw + J_vw, J_vw_v[only_v])))
+    P_minus, dP_minus = product(edge_t, 2*np.concatenate((J_uw - J_vw, J_vw_v[only_v])))
+
+    sin_J, cos_J = np.sin(2*gamma*edges_J), np.cos(2*gamma*edges_J)
+    a, b = np.sin(4*beta) / 2, np.sin(2*beta)**2 / 2
+    zz = a * sin_J * (P_u + P_v) - b * (P_plus - P_minus)
+    dzz_gamma = a * (2*edges_J * cos_J * (P_u + P_v) + sin_J * (dP_u + dP_v)) - b * (dP_plus - dP_minus)
+    dzz_beta  = 2*np.cos(4*beta) * sin_J * (P_u + P_v) - np.sin(4*beta) * (P_plus - P_minus)
+
+    # cut = -(offset + sum J_uv z_u z_v)
+    expected_cut = -(offset + edges_J.dot(zz))
+    gradient = -np.array([edges_J.dot(dzz_gamma), edges_J.dot(dzz_beta)])
+    return expected_cut, gradient
+
+
+# Initial angles for QAOA from the closed-form depth-1 expectation
+def QAOA_p1_initial_point(QUBO, depth = 1, n_grid = 10):
+    """Returns the gamma_beta parameters of 'QAOA_circuit' (Ising mode,
+    ising = qubo_to_pauli(QUBO), no fixed vertex) maximizing the depth-1
+    expected cut of 'QAOA_p1_expectation', and the expected cut.
+
+    The best point of an n_grid x n_grid grid in gamma, beta is refined
+    by L-BFGS-B with the analytic gradient. For depth > 1, the same
+    angles are repeated in every layer, which gave a better starting
+    point than identity layers (gamma = beta = 0) or angles split
+    among the layers. All theta are PI/2: this point is stationary in
+    theta, so it suits COBYLA better than gradient-based optimizers.
+    """
+    n = QUBO.shape[0]
+    # gamma is periodic only for integer couplings: scan a range
+    # scaled by the largest coupling
+    scale = np.max(np.abs(sparse.csr_matrix(QUBO).data)) / 2
+    gammas = np.linspace(0, PI / scale, n_grid, endpoint = False)[1:]
+    betas  = np.linspace(0, PI / 2, n_grid, endpoint = False)[1:]
+    best = max(((QAOA_p1_expectation(QUBO, g, b)[0], g, b) for g in gammas for b in betas))
+
+    res = minimize(fun    = lambda x: tuple(-v for v in QAOA_p1_expectation(QUBO, x[0], x[1])),
+                   x0     = best[1:],
+                   jac    = True,
+                   method = 'L-BFGS-B')
+
+    gamma_beta = np.concatenate((np.repeat(res.x[0], depth),
+                                 np.repeat(res.x[1], depth),
+                                 np.repeat(PI/2, n)))
+    return gamma_beta, -res.fun
+
+
+# Unpack a set of integers into a matrix of bits
+def bits_from_integers(integers, n):
+    """Returns a (len(integers) x n) uint8 matrix of bits.
+
+    Column i contains the i-th bit (least significant first)
+    of each integer, i.e. the same ordering used by
+    'brute_force_solver' to label the vertices.
+    """
+    integers = np.asarray(integers, dtype = np.int64)
+    return ((integers[:, None] >> np.arange(n, dtype = np.int64)) & 1).astype(np.uint8)
+
+
+# Max-Cut value of a chunk of assignments
+def cut_values(x, Q):
+    """Returns the cost x.Q.(1-x) of each row of the bit matrix x.
+
+    x: (n_states x n) matrix of 0 and 1,
+    Q: the original QUBO matrix.
+
+    The whole chunk is evaluated with a single matrix product.
+    """
+    x = x.astype(Q.dtype)
+    return np.einsum('ij,ij->i', x.dot(Q), 1 - x)
+
+
+# Gray-code enumeration of a range of assignments, evaluated chunk by chunk
+def gray_code_cut_values(Q, start, stop, chunk_size):
+    """Yields (states, costs) for the assignments of a Max-Cut problem,
+    enumerating the high bits of the states in Gray-code order.
+
+    Q: the original QUBO matrix,
+    start, stop: range of the Gray-code counter, in units of states
+    (both must be multiples of chunk_size),
+    chunk_size: a power of 2, 2^L.
+
+    The L low vertices are enumerated as a whole chunk, the n-L high
+    vertices follow a Gray code, so that two consecutive chunks differ
+    by the flip of a single high vertex. For fixed high vertices the cost
+    x.Q.(1-x) is the (precomputed) cost of the low vertices plus a linear
+    function of them: its coefficients and constant term are updated in
+    O(degree) at each flip, using the adjacency list of the flipped vertex.
+    """
+    # The running coefficients are updated in place with float signs
+    Q = np.asarray(Q, dtype = float)
+    n = Q.shape[0]
+    L = min(int(np.log2(chunk_size)), n)
+    if 2**L != chunk_size and L != n:
+        raise ValueError("'chunk_size' must be a power of 2 for the Gray-code enumeration")
+    if start % 2**L != 0 or (stop % 2**L != 0 and stop != 2**n):
+        raise ValueError("'start' and 'stop' must be multiples of 'chunk_size'")
+
+    low  = np.arange(L)
+    high = np.arange(L, n)
+
+    # Cost function of the low vertices alone, for all their 2^L values
+    low_costs = cut_values(bits_from_integers(np.arange(2**L), L), Q[np.ix_(low, low)])
+
+    # Constant part of the linear coefficients of the low vertices and
+    # adjacency lists of the high vertices (symmetrized couplings)
+    R = Q[np.ix_(low, high)].sum(axis = 1)
+    S = Q + Q.T
+    row_sums  = Q.sum(axis = 1) - np.diag(Q)
+    low_adj   = [np.nonzero(S[low, v])[0] for v in range(n)]
+    high_adj  = [L + np.nonzero(S[high, v])[0] for v in range(n)]
+    high_adj  = [adj[adj != v] for v, adj in zip(range(n), high_adj)]
+
+    # Initial high assignment, computed from scratch
+    t = start >> L
+    x = bits_from_integers([t ^ (t >> 1)], n - L)[0].astype(Q.dtype)
+    x_full = np.concatenate((np.zeros(L), x))
+    coeff  = R - S[np.ix_(low, high)].dot(x)
+    const  = cut_values(x[None, :], Q[np.ix_(high, high)])[0] + x.dot(Q[np.ix_(high, low)].sum(axis = 1))
+
+    low_states = np.arange(2**L, dtype = np.int64)
+    linear     = np.empty(2**L)
+    for t in range(start >> L, -(-stop >> L)):
+        if t != start >> L:
+            # flip the high vertex given by the lowest set bit of t
+            v    = L + (t & -t).bit_length() - 1
+            sign = 1 - 2*x_full[v]
+            const += sign * (row_sums[v] - S[v, high_adj[v]].dot(x_full[high_adj[v]]))
+            coeff[low_adj[v]] -= sign * S[low_adj[v], v]
+            x_full[v] = 1 - x_full[v]
+
+        # linear term of all the 2^L low assignments (subset sums of coeff)
+        linear[0] = 0
+        for k in range(L):
+            linear[2**k:2**(k+1)] = linear[:2**k] + coeff[k]
+
+        g = t ^ (t >> 1)
+        yield (g << L) + low_states, low_costs + linear + const
+
+
+# Chunks of assignments and their cost function values
+def cut_values_chunks(Q, start, stop, chunk_size, method = "matmul"):
+    """Yields (states, costs) for the assignments in [start, stop).
+
+    method: 'matmul' unpacks each chunk of consecutive states and
+    evaluates it with 'cut_values', 'gray' uses 'gray_code_cut_values'
+    (the states of a chunk are then not consecutive).
+    """
+    n = Q.shape[0]
+    if method == "matmul":
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            states = np.arange(chunk_start, chunk_stop, dtype = np.int64)
+            yield states, cut_values(bits_from_integers(states, n), Q)
+    elif method == "gray":
+        for chunk in gray_code_cut_values(Q, start, stop, chunk_size):
+            yield chunk
+    else:
+        raise ValueError("Please select a valid enumeration method ('matmul' or 'gray')")
+
+
+# Move the vertex whose side is fixed to the last position
+def fixed_vertex_problem(Q, fix_vertex):
+    """Returns the QUBO matrix with vertex 'fix_vertex' moved to the
+    last position, and the permutation of the vertices used.
+
+    For a symmetric Q a cut x and its complement 1-x have the same
+    cost, so 'fix_vertex' can be kept on side 0: the first 2^(n-1)
+    states of the permuted problem are all the cuts with this property.
+    """
+    if not np.allclose(Q, Q.T):
+        raise ValueError("A vertex can be fixed only if the QUBO matrix is symmetric")
+    n = Q.shape[0]
+    perm = [v for v in range(n) if v != fix_vertex] + [fix_vertex]
+    return Q[np.ix_(perm, perm)], perm
+
+
+# Full-length assignments of a problem with a fixed vertex
+def fixed_vertex_solutions(states, n, perm):
+    """Returns the bit matrix of the states of a permuted problem
+    (see 'fixed_vertex_problem') in the original vertex order,
+    followed by their complements.
+    """
+    x = np.empty((len(states), n), dtype = np.uint8)
+    x[:, perm] = bits_from_integers(states, n)
+    return np.concatenate((x, 1 - x))
+
+
 # Solve a Max-Cut problem using brute force approach
-def brute_force_solver(Q, verbosity = False):
+def brute_force_solver(Q,
+                       verbosity         = False,
+                       chunk_size        = 2**16,
+                       store_eigenvalues = True,
+                       method            = "matmul",
+                       fix_vertex        = None):
     """Solve a Max-Cut problem using brute force approach.
-    
-    Returns the solutions as a list of strings. 
+
+    Returns the solutions as a list of strings.
     If verbosity is set to true, the graph is plotted
-    with the two subsets of vertices painted with different 
+    with the two subsets of vertices painted with different
     colors.
+
+    The 2^n assignments are enumerated in chunks of 'chunk_size'
+    states: with method = 'matmul' each chunk is unpacked into a bit
+    matrix and all its cost function values are computed at once by
+    'cut_values', with method = 'gray' the chunks follow a Gray code
+    and are updated incrementally (see 'gray_code_cut_values').
+    If store_eigenvalues is False, the full array of 2^n
+    eigenvalues is not kept and None is returned in its place.
+
+    If fix_vertex is set, that vertex is kept on side 0 and only
+    2^(n-1) assignments are enumerated (Q must be symmetric):
+    the solutions are completed with their complements, while the
+    eigenvalues returned are the 2^(n-1) ones of the enumerated half,
+    which has the same mean and standard deviation as the full spectrum.
     """
-    # The graph associated to the QUBO matrix
-    G = nx.from_numpy_matrix(Q)
     # Initialize best cost function value
-    best_cost_brute = 0 
+    best_cost_brute = 0
     # Get matrix shape
     n = Q.shape[0]
+    n_states = 2**n
+    # Problem actually enumerated
+    Q_enum = Q
+    if fix_vertex is not None:
+        Q_enum, perm = fixed_vertex_problem(Q, fix_vertex)
+        n_states   = 2**(n-1)
+        chunk_size = min(chunk_size, n_states)
     # computing all possible combinations
     # initialize output
-    xbest_brute = []
+    best_states = []
     # store all the eigenvalues to get mean and std-dev
-    eigenvalues = np.array([])
-    for b in range(2**n):
-        # x stores all the 2^n possible combinations of 0 and 1
-        # for a vector of length n 
-        x = [int(t) for t in reversed(list(bin(b)[2:].zfill(n)))]
-        # initialize cost function value
-        cost = 0
-        # scan all possible costs and keep the highest one
-        # (now we want to maximize our score!)
-        for i in range(n):
-            for j in range(n):
-                cost = cost + Q[i,j]*x[i]*(1 - x[j])
-        # store the cost function value as a eigenvalue
-        eigenvalues = np.append(eigenvalues, cost)
-        if cost > best_cost_brute:
-            xbest_brute = [x] 
-            best_cost_brute = cost
-        elif cost == best_cost_brute:
-            xbest_brute.append(x) 
-    
-    # Showing results    
-    if verbosity == True:    
+    eigenvalues = None
+    if store_eigenvalues == True:
+        eigenvalues = np.empty(n_states)
+    # states and cost function values of each chunk
+    # (now we want to maximize our score!)
+    for states, costs in cut_values_chunks(Q_enum, 0, n_states, chunk_size, method):
+        # store the cost function values as eigenvalues
+        if store_eigenvalues == True:
+            eigenvalues[states] = costs
+        chunk_best = costs.max()
+        if chunk_best > best_cost_brute:
+            best_states = list(states[costs == chunk_best])
+            best_cost_brute = chunk_best
+        elif chunk_best == best_cost_brute:
+            best_states.extend(states[costs == chunk_best])
+
+    # x stores the best combinations of 0 and 1
+    # for a vector of length n
+    if fix_vertex is None:
+        xbest_brute = bits_from_integers(sorted(best_states), n)
+    else:
+        xbest_brute = fixed_vertex_solutions(best_states, n, perm)
+        xbest_brute = xbest_brute[np.argsort(xbest_brute.dot(2**np.arange(n)))]
+    xbest_brute = xbest_brute.tolist()
+
+    # Showing results
+    if verbosity == True:
+        # The graph associated to the QUBO matrix
+        G = nx.from_numpy_matrix(Q)
         colors = ['r' if xbest_brute[0][i] == 0 else 'b' for i in range(n)]
         nx.draw_networkx(G, node_color = colors)
-        print('\nBest solution = ' + str(xbest_brute) + ' cost = ' + str(best_cost_brute)) 
-    
+        print('\nBest solution = ' + str(xbest_brute) + ' cost = ' + str(best_cost_brute))
+
     # Transform the solution in a list of strings
     for res in range(len(xbest_brute)):
         xbest_brute[res] = ''.join(map(str, xbest_brute[res]))
@@ -786,6 +2938,191 @@ def brute_force_solver(Q, verbosity = False):
     return xbest_brute, best_cost_brute, eigenvalues
 
 
+# Merge the running moments of two sets of eigenvalues
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Returns count, mean and sum of squared deviations (m2)
+    of the union of two sets, given the same quantities
+    computed separately for each set (Chan et al. formula).
+    """
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0., 0.
+    delta = mean_b - mean_a
+    mean  = mean_a + delta * count_b / count
+    m2    = m2_a + m2_b + delta**2 * count_a * count_b / count
+    return count, mean, m2
+
+
+# Keep only the 'top_k' highest cost function values
+def merge_top_k(costs_a, states_a, costs_b, states_b, top_k):
+    """Merges two (costs, states) lists and keeps the 'top_k'
+    entries with the highest costs, sorted by decreasing cost
+    and increasing state.
+    """
+    costs  = np.concatenate((costs_a, costs_b))
+    states = np.concatenate((states_a, states_b))
+    order  = np.lexsort((states, -costs))[:top_k]
+    return costs[order], states[order]
+
+
+# Reduce a shard of the 2^n assignments to a few summary quantities
+def brute_force_shard(args):
+    """Scans the assignments in [start, stop) of a Max-Cut problem.
+
+    args: tuple (Q, start, stop, chunk_size, top_k, bin_edges, method),
+    see 'cut_values_chunks' for the enumeration methods.
+
+    Returns a dictionary with the number of states, the mean and the
+    sum of squared deviations of their cost function values, the
+    histogram of the values in 'bin_edges' and the 'top_k' best
+    states (as integers, same bit ordering as 'brute_force_solver')
+    with their costs.
+    Used by 'brute_force_parallel' as the task of each worker.
+    """
+    Q, start, stop, chunk_size, top_k, bin_edges, method = args
+
+    count, mean, m2 = 0, 0., 0.
+    hist       = np.zeros(len(bin_edges) - 1, dtype = np.int64)
+    top_costs  = np.array([])
+    top_states = np.array([], dtype = np.int64)
+
+    for states, costs in cut_values_chunks(Q, start, stop, chunk_size, method):
+        # running moments and histogram of the spectrum
+        count, mean, m2 = merge_moments(count, mean, m2,
+                                        len(costs), costs.mean(), ((costs - costs.mean())**2).sum())
+        hist += np.histogram(costs, bins = bin_edges)[0]
+
+        # best states of the chunk
+        if len(costs) > top_k:
+            best = np.argpartition(-costs, top_k - 1)[:top_k]
+            costs, states = costs[best], states[best]
+        top_costs, top_states = merge_top_k(top_costs, top_states, costs, states, top_k)
+
+    return {"count"      : count,
+            "mean"       : mean,
+            "m2"         : m2,
+            "hist"       : hist,
+            "top_costs"  : top_costs,
+            "top_states" : top_states}
+
+
+# Solve a Max-Cut problem using brute force approach on several processes
+import multiprocessing
+
+def brute_force_parallel(Q,
+                         n_workers  = None,
+                         top_k      = 64,
+                         n_bins     = 100,
+                         chunk_size = 2**16,
+                         method     = "matmul",
+                         fix_vertex = None,
+                         verbosity  = False):
+    """Solve a Max-Cut problem using brute force approach,
+    splitting the 2^n assignments across a pool of processes.
+
+    Q: the original QUBO matrix,
+    n_workers: number of processes (default: number of CPUs),
+    top_k: number of best states kept by each worker,
+    n_bins: number of bins of the eigenvalues histogram,
+    chunk_size: number of states evaluated at once,
+    method: enumeration method, 'matmul' or 'gray' (see 'cut_values_chunks'),
+    fix_vertex: if set, this vertex is kept on side 0 and only 2^(n-1)
+    assignments are enumerated (see 'brute_force_solver'); the best states
+    are completed with their complements.
+
+    No worker keeps the full list of eigenvalues: each shard is
+    reduced to its 'top_k' best states plus the count, mean, variance
+    and histogram of its eigenvalues, and these summaries are merged.
+
+    Returns the solutions as a list of strings (like 'brute_force_solver'),
+    the best cost and a dictionary describing the whole spectrum, with keys
+    'count', 'mean', 'var', 'std', 'hist', 'bin_edges', 'top_costs' and
+    'top_states' (the best 'top_k' states as strings).
+    """
+    n = Q.shape[0]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    # The cut value is bounded by the sums of the negative
+    # and positive off-diagonal terms of Q
+    off_diag  = Q - np.diag(np.diag(Q))
+    bin_edges = np.linspace(off_diag[off_diag < 0].sum(),
+                            off_diag[off_diag > 0].sum(),
+                            n_bins + 1)
+
+    # Problem actually enumerated
+    Q_enum   = Q
+    n_states = 2**n
+    if fix_vertex is not None:
+        Q_enum, perm = fixed_vertex_problem(Q, fix_vertex)
+        n_states   = 2**(n-1)
+        chunk_size = min(chunk_size, n_states)
+
+    # A few shards per worker, each one made of whole chunks
+    shard_size = chunk_size * max(1, -(-n_states // (4 * n_workers * chunk_size)))
+    tasks = [(Q_enum, start, min(start + shard_size, n_states), chunk_size, top_k, bin_edges, method)
+             for start in range(0, n_states, shard_size)]
+
+    pool = None
+    if n_workers == 1:
+        shards = map(brute_force_shard, tasks)
+    else:
+        pool   = multiprocessing.Pool(n_workers)
+        shards = pool.imap_unordered(brute_force_shard, tasks)
+
+    # Merge the summaries of all the shards
+    count, mean, m2 = 0, 0., 0.
+    hist       = np.zeros(n_bins, dtype = np.int64)
+    top_costs  = np.array([])
+    top_states = np.array([], dtype = np.int64)
+    try:
+        for shard in shards:
+            count, mean, m2 = merge_moments(count, mean, m2,
+                                            shard["count"], shard["mean"], shard["m2"])
+            hist += shard["hist"]
+            top_costs, top_states = merge_top_k(top_costs, top_states,
+                                                shard["top_costs"], shard["top_states"], top_k)
+    finally:
+        # The workers are released even if a shard fails
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if np.all(top_costs == top_costs[0]) and len(top_costs) == top_k:
+        warnings.warn("All the {0} states kept are optimal, increase 'top_k' to get all the solutions".format(top_k))
+
+    # Transform the states in strings
+    if fix_vertex is None:
+        top_x = bits_from_integers(top_states, n)
+    else:
+        top_x     = fixed_vertex_solutions(top_states, n, perm)
+        top_costs = np.concatenate((top_costs, top_costs))
+        order     = np.lexsort((top_x.dot(2**np.arange(n)), -top_costs))
+        top_x, top_costs = top_x[order], top_costs[order]
+    top_strings = [''.join(map(str, x)) for x in top_x.tolist()]
+
+    best_cost_brute = top_costs[0]
+    xbest_brute = [top_strings[k] for k in range(len(top_costs)) if top_costs[k] == best_cost_brute]
+
+    spectrum = {"count"      : count,
+                "mean"       : mean,
+                "var"        : m2 / count,
+                "std"        : np.sqrt(m2 / count),
+                "hist"       : hist,
+                "bin_edges"  : bin_edges,
+                "top_costs"  : top_costs,
+                "top_states" : top_strings}
+
+    # Showing results
+    if verbosity == True:
+        G = nx.from_numpy_matrix(Q)
+        colors = ['r' if xbest_brute[0][i] == '0' else 'b' for i in range(n)]
+        nx.draw_networkx(G, node_color = colors)
+        print('\nBest solution = ' + str(xbest_brute) + ' cost = ' + str(best_cost_brute))
+
+    return xbest_brute, best_cost_brute, spectrum
+
+
 # Load results from pickle file and prepare them for analysis
 def load_files(file_name, shot_list):
     """Load results from pickle file and prepare them for analysis.
@@ -832,7 +3169,8 @@ def analyze_results(scan,
                     weights, 
                     brute_solution, 
                     cost_function,
-                    alpha = 1):
+                    alpha = 1,
+                    cache = None):
     """Analyzes the results loaded by 'load_files' function.
     
     scan: the object returned by 'load_files';
@@ -843,15 +3181,13 @@ def analyze_results(scan,
     cost_function: the cost function used in the optimization
     ('cost' or 'cvar');
     alpha: in case the cost function is 'cvar', the CVaR
-    alpha parameter used in the optimization.
+    alpha parameter used in the optimization;
+    cache: optional 'EnergyCache' bound to weights.
     
     The function returns a 
     """
     # fraction of solution containing the optimal solution
-    frac_list = np.array([])
-    for shot in shot_list:
-        frac = F_opt_finder(scan, shot, weights, brute_solution)
-        frac_list = np.append(frac_list, frac)
+    frac_list = F_opt_all_shots(scan, shot_list, weights, brute_solution, cache = cache)
         
     # Prepare the results so that it is easier to plot them
     
@@ -865,10 +3201,10 @@ def analyze_results(scan,
     for i in range(len(scan)):
         nfevs = np.append(nfevs, scan[i][3])
 
-    # Create list of shots
-    nshots = np.array([])
+    # Create list of shots (numbers or schedule/estimator labels)
+    nshots = []
     for i in range(len(scan)):
-        nshots = np.append(nshots, scan[i][2])
+        nshots.append(scan[i][2])
 
     # Create list of number of eigenstates in the solution
     neigenst = np.array([])
@@ -889,19 +3225,21 @@ def analyze_results(scan,
     df = pd.DataFrame(list(zip(ntimes, nfevs, nshots, neigenst, ncost, ntheta)), 
                columns = ['time', 'nfevs', 'shots', 'eigenstates', 'cost', 'theta'])
 
-    # Add the total number of circuit evaluation
-    df['ncircevs'] = df['nfevs'] * df['shots']
+    # Add the total number of circuit evaluation: the one reported
+    # by 'time_vs_shots' if available (e.g. with a 'ShotSchedule')
+    df['ncircevs'] = [res[7]["circuit_evaluations"] if len(res) > 7 else res[3] * res[2]
+                      for res in scan]
 
-    # Group by shots and average
-    df_plot = df.groupby(['shots']).mean()
+    # Group by shots and average (in order of appearance: the shots may
+    # mix numbers and 'ShotSchedule' labels, which cannot be sorted)
+    df_plot = df.groupby(['shots'], sort = False).mean(numeric_only = True)
     df_plot.reset_index(level=0, inplace=True)
-    df_plot["frac"] = frac_list
+    df_plot["frac"] = df_plot["shots"].map(dict(zip(shot_list, frac_list)))
     
     # Group by shots and take standard deviation - used for cost function only
-    df_std_dev = df.groupby(['shots']).std()
-    df_std_dev.reset_index(level=0, inplace=True)
+    df_std_dev = df.groupby(['shots'], sort = False)["cost"].std()
     # Add cost function std-dev to df_plot
-    df_plot["cost_std_dev"] = df_std_dev["cost"]    
+    df_plot["cost_std_dev"] = df_plot["shots"].map(df_std_dev)    
     
     return df, df_plot
 
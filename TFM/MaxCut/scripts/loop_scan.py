@@ -18,6 +18,10 @@
 # python3 loop_scan.py cvar 0.5 13 39
 # python3 loop_scan.py cvar 0.2 13 39
 
+# Optional fifth argument: the backend. With numpy_simulator, every circuit
+# is simulated once and the shots are drawn from its exact distribution:
+# python3 loop_scan.py cost 1   10 22 numpy_simulator
+
 import sys, os
 
 n_vertices = 10
@@ -29,6 +33,9 @@ cost       = sys.argv[1]
 alpha      = sys.argv[2]
 n_vertices = sys.argv[3]
 n_edges    = sys.argv[4]
+backend    = 'qasm_simulator'
+if len(sys.argv) > 5:
+    backend = sys.argv[5]
 
 # keep the ratio n_edges/max(n_edges) constant for all n_vertices values
 n_edges = int(0.5*n_vertices*(n_vertices-1) * 0.5)
@@ -36,10 +43,11 @@ n_edges = int(0.5*n_vertices*(n_vertices-1) * 0.5)
 shots_list = [1, 2, 4, 8, 12, 16, 24, 32, 64, 96, 128, 192, 256, 512]
 
 for shots in shots_list:
-    command = "python3.7 scan_script.py {0} {1} {2} {3} {4} &".format(shots,
-                                                                     cost,
-                                                                     alpha,
-                                                                     n_vertices,
-                                                                     n_edges)
+    command = "python3.7 scan_script.py {0} {1} {2} {3} {4} {5} &".format(shots,
+                                                                         cost,
+                                                                         alpha,
+                                                                         n_vertices,
+                                                                         n_edges,
+                                                                         backend)
     print(command)
     os.system(command)
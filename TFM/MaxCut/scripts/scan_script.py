@@ -22,7 +22,8 @@ if len(sys.argv) < 4:
     cost function type 
     CVaR alpha value
     number of vertices
-    number of edges""")
+    number of edges
+    backend (optional, default 'qasm_simulator')""")
 
 n_shots = sys.argv[1]
 n_cost  = sys.argv[2]
@@ -30,12 +31,19 @@ n_alpha = sys.argv[3]
 n_n     = sys.argv[4]
 n_E     = sys.argv[5]
 
+# 'numpy_simulator' simulates each parameter vector once and draws the shots
+# from its exact distribution (see 'ShotEmulator' in Functions.py)
+n_backend = 'qasm_simulator'
+if len(sys.argv) > 6:
+    n_backend = sys.argv[6]
+
 # Print input values
 print("Shots:         {0}".format(n_shots))
 print("Cost function: {0}".format(n_cost))
 print("Alpha:         {0}".format(n_alpha))
 print("N vertices:    {0}".format(n_n))
 print("N edges:       {0}".format(n_E))
+print("Backend:       {0}".format(n_backend))
     
 # Create random Max-Cut problem
 # Number of vertices
@@ -56,7 +64,7 @@ WEIGHTS       = W2
 N_QBITS       = n
 DEPTH         = 2
 SHOTS         = int(n_shots)
-BACKEND       = 'qasm_simulator'
+BACKEND       = n_backend
 FINAL_EVAL    = 128
 COST          = n_cost
 ALPHA         = float(n_alpha)